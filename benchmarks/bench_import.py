@@ -0,0 +1,113 @@
+'''
+Time spent importing modules when launching synaptogram
+
+Each target is imported in a new process using `python -X importtime` and the
+time spent in each module is reported. Targets are:
+
+* gui - modules needed to show the main window (see `synaptogram.main.import_gui`)
+* dataset - modules imported when the first dataset is opened (the reader,
+  presenters and plots)
+* any other name is imported as a module (e.g., `synaptogram.reader`)
+
+The first import of a module compiles it, so the imports are repeated
+(`--repeat`) and the median is reported. Use `--budget` to exit with an error
+if the total time exceeds the budget (e.g., to catch regressions in CI).
+
+    python benchmarks/bench_import.py gui dataset --top 20 --output imports.csv
+'''
+import argparse
+import re
+import subprocess
+import sys
+
+import pandas as pd
+
+
+TARGETS = {
+    'gui': 'from synaptogram.main import import_gui; import_gui()',
+    'dataset': '\n'.join([
+        'import enaml',
+        'import synaptogram.presenter',
+        'with enaml.imports():',
+        '    import synaptogram.points_view',
+    ]),
+}
+
+P_IMPORTTIME = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def parse_importtime(output):
+    '''
+    Parse the output of `python -X importtime`
+
+    Returns a DataFrame with the self and cumulative time (ms) of each module
+    along with its depth in the import tree.
+    '''
+    rows = []
+    for line in output.splitlines():
+        if (m := P_IMPORTTIME.match(line)) is not None:
+            self_us, cumulative_us, indent, module = m.groups()
+            rows.append({
+                'module': module,
+                'package': module.split('.')[0],
+                'depth': len(indent) // 2,
+                'self_ms': int(self_us) / 1e3,
+                'cumulative_ms': int(cumulative_us) / 1e3,
+            })
+    return pd.DataFrame(rows, columns=['module', 'package', 'depth', 'self_ms', 'cumulative_ms'])
+
+
+def profile_imports(target):
+    code = TARGETS.get(target, f'import {target}')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        errors = [l for l in result.stderr.splitlines() if not l.startswith('import time:')]
+        raise RuntimeError(f'Unable to import {target}:\n' + '\n'.join(errors))
+    return parse_importtime(result.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser('Benchmark the time spent importing modules')
+    parser.add_argument('targets', nargs='*', default=['gui'],
+                        help='gui, dataset or module names')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--top', type=int, default=15,
+                        help='Number of modules and packages to list')
+    parser.add_argument('--budget', type=float,
+                        help='Exit with an error if a target takes longer than this (ms)')
+    parser.add_argument('--output', help='Save the time for each module to this CSV file')
+    args = parser.parse_args()
+
+    results = []
+    for target in args.targets:
+        # Compile the modules (if needed) before timing.
+        profile_imports(target)
+        for i in range(args.repeat):
+            result = profile_imports(target)
+            results.append(result.assign(target=target, repeat=i))
+    results = pd.concat(results, ignore_index=True)
+    if args.output:
+        results.to_csv(args.output, index=False)
+
+    pd.set_option('display.width', 200)
+    over_budget = []
+    for target, result in results.groupby('target', sort=False):
+        modules = result.groupby(['module', 'package'])[['self_ms', 'cumulative_ms']].median()
+        total = result[result['depth'] == 0].groupby('repeat')['cumulative_ms'].sum().median()
+        print(f'\n{target}: {total:.0f} ms')
+        print('\nSlowest packages (self time, ms)')
+        packages = modules.groupby('package')['self_ms'].sum().sort_values(ascending=False)
+        print(packages.head(args.top).round(1).to_string())
+        print('\nSlowest modules (ms)')
+        modules = modules.sort_values('cumulative_ms', ascending=False).reset_index('package', drop=True)
+        print(modules.head(args.top).round(1).to_string())
+        if args.budget is not None and total > args.budget:
+            over_budget.append(f'{target} ({total:.0f} ms)')
+
+    if over_budget:
+        sys.exit(f'Over budget of {args.budget:.0f} ms: {", ".join(over_budget)}')
+
+
+if __name__ == '__main__':
+    main()
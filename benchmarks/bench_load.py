@@ -0,0 +1,186 @@
+'''
+Time each stage of loading a dataset up to the first paint of the GUI
+
+Synthetic Imaris files are generated for each combination of volume size and
+number of spots (see `synthetic.py`) and the following stages are timed:
+
+* metadata - parse image information and spots
+* channels - read the full-resolution volume for all channels
+* overview - maximum projection of the coarsest level (shown on load)
+* tiles - extract the tile around each spot
+* sort - compute the sort statistics and ordering
+* render - render the first screen of the tile mosaic and the overview
+* paint - draw both images into a figure (Agg backend)
+
+The wall time and peak memory allocated (as tracked by `tracemalloc`) are
+reported for each stage. Rendering is done offscreen, so no display is
+needed. Each run opens the file from scratch (with the tile cache disabled),
+so the times are for a cold load (although the file may be in the operating
+system's cache). Use `--read-workers` to compare the number of threads used to
+decompress the image and `--tile-dtype` to compare the dtype the tiles are
+stored in (`image` stores them in the dtype of the image, see `--dtype`).
+
+    python benchmarks/bench_load.py --shape 512x512x64 1024x1024x64 --n-points 1000 10000 --read-workers 1 4
+    python benchmarks/bench_load.py --dtype uint16 --tile-dtype image uint8
+'''
+import argparse
+import itertools
+from pathlib import Path
+import tempfile
+import time
+import tracemalloc
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+from synaptogram.config import CHANNEL_CONFIG
+from synaptogram.model import TiledNDImage, VolumeNDImage
+from synaptogram.reader import ImarisReader
+
+from synthetic import make_imaris_file
+
+
+STAGES = ['metadata', 'channels', 'overview', 'tiles', 'sort', 'render', 'paint']
+
+
+class StageTimer:
+
+    def __init__(self):
+        self.results = []
+
+    def __call__(self, stage):
+        self.stage = stage
+        return self
+
+    def __enter__(self):
+        tracemalloc.reset_peak()
+        self.start_mem, _ = tracemalloc.get_traced_memory()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self.start
+        _, peak = tracemalloc.get_traced_memory()
+        self.results.append({
+            'stage': self.stage,
+            'time_ms': elapsed * 1e3,
+            'peak_mb': (peak - self.start_mem) / 1024**2,
+        })
+
+
+def run(path, marker='CtBP2', size=10, n_rows=8, read_workers=None, tile_dtype=None):
+    timer = StageTimer()
+    tracemalloc.start()
+    try:
+        reader = ImarisReader(path, cache=False, read_workers=read_workers,
+                              tile_dtype=tile_dtype)
+        with timer('metadata'):
+            image_info = reader.image_info
+            reader.points
+            levels = reader.resolution_levels
+
+        with timer('channels'):
+            np.asarray(reader.image)
+
+        overview = VolumeNDImage(image_info, reader.image, levels=levels,
+                                 channel_defaults=CHANNEL_CONFIG)
+        with timer('overview'):
+            overview.get_z_projection(overview.n_levels - 1)
+
+        with timer('tiles'):
+            tile_info, tiles, codec = reader.get_tiles(marker, size)
+
+        with timer('sort'):
+            tiled = TiledNDImage(image_info, tile_info, tiles, codec)
+            tiled.sort_value = 'mean'
+
+        with timer('render'):
+            rows = (0, min(n_rows, tiled.n_rows))
+            tile_image = tiled.get_image(None, rows=rows)
+            level = overview.n_levels - 1
+            overview_image = overview.get_image(level=level)
+
+        with timer('paint'):
+            figure, axes = plt.subplots(1, 2, figsize=(12, 6), dpi=100)
+            axes[0].imshow(overview_image, origin='lower',
+                           extent=overview.get_region_extent(level))
+            axes[1].imshow(tile_image, origin='lower',
+                           extent=tiled.get_rows_extent(*rows))
+            figure.canvas.draw()
+            plt.close(figure)
+    finally:
+        tracemalloc.stop()
+    return timer.results
+
+
+def parse_shape(value):
+    return tuple(int(v) for v in value.split('x'))
+
+
+def main():
+    parser = argparse.ArgumentParser('Benchmark loading of synthetic Imaris files')
+    parser.add_argument('--shape', type=parse_shape, nargs='+',
+                        default=[(256, 256, 32), (512, 512, 64), (1024, 1024, 64)],
+                        help='Volume size (XxYxZ voxels)')
+    parser.add_argument('--n-points', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--size', type=int, default=10, help='Tile size (voxels)')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--read-workers', type=int, nargs='+',
+                        default=[ImarisReader.read_workers],
+                        help='Number of threads used to decompress the image')
+    parser.add_argument('--dtype', default='uint8', help='Dtype of the synthetic image')
+    parser.add_argument('--tile-dtype', nargs='+', default=['image'],
+                        help='Dtype to store the tiles in (image for the dtype of the image)')
+    parser.add_argument('--workdir', help='Folder to save the synthetic files to '
+                        '(defaults to a temporary folder)')
+    parser.add_argument('--output', help='Save results to this CSV file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = Path(args.workdir or tmpdir)
+        workdir.mkdir(parents=True, exist_ok=True)
+        results = []
+        for shape in args.shape:
+            for n_points in args.n_points:
+                name = f'{"x".join(map(str, shape))}-{n_points}'
+                if args.dtype != 'uint8':
+                    name = f'{name}-{args.dtype}'
+                # The channel names are parsed from the filename.
+                path = workdir / f'{name}_63x-GluR2-CtBP2-MyosinVIIa_IHC_1.ims'
+                if not path.exists():
+                    print(f'Generating {path.name}')
+                    make_imaris_file(path, shape=shape, n_points=n_points, dtype=args.dtype)
+                for read_workers, tile_dtype, i in itertools.product(
+                        args.read_workers, args.tile_dtype, range(args.repeat)):
+                    kwargs = {
+                        'size': args.size,
+                        'read_workers': read_workers,
+                        'tile_dtype': None if tile_dtype == 'image' else tile_dtype,
+                    }
+                    for result in run(path, **kwargs):
+                        results.append({'shape': 'x'.join(map(str, shape)),
+                                        'n_points': n_points,
+                                        'read_workers': read_workers,
+                                        'tile_dtype': tile_dtype,
+                                        'repeat': i, **result})
+
+    results = pd.DataFrame(results)
+    if args.output:
+        results.to_csv(args.output, index=False)
+
+    groups = ['shape', 'n_points', 'read_workers', 'tile_dtype', 'stage']
+    summary = results.groupby(groups, sort=False) \
+        [['time_ms', 'peak_mb']].median().unstack('stage')
+    pd.set_option('display.width', 200)
+    for column in ('time_ms', 'peak_mb'):
+        print(f'\n{column}')
+        table = summary[column][STAGES]
+        if column == 'time_ms':
+            table = table.assign(total=table.sum(axis=1))
+        print(table.round(1).to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+'''
+Compare rank lookups in TiledNDImage against linear `list.index` scans.
+
+    python benchmarks/bench_ordering.py --n-tiles 20000 --n-labels 5000
+'''
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from synaptogram.model import TiledNDImage
+
+
+def make_tiled_image(n_tiles, rng):
+    info = {
+        'lower': [0, 0, 0],
+        'voxel_size': [0.1, 0.1, 0.1],
+        'channels': [{'name': 'GluR2'}, {'name': 'CtBP2'}],
+    }
+    tile_info = pd.DataFrame({'x': np.zeros(n_tiles)})
+    tiles = rng.integers(0, 255, size=(n_tiles, 4, 4, 4, 2), dtype=np.uint8)
+    return TiledNDImage(info, tile_info, tiles)
+
+
+def timeit(fn, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser('Benchmark ordering lookups')
+    parser.add_argument('--n-tiles', type=int, default=20000)
+    parser.add_argument('--n-labels', type=int, default=5000)
+    parser.add_argument('--n-steps', type=int, default=1000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    obj = make_tiled_image(args.n_tiles, rng)
+    ordering = obj.ordering.tolist()
+    labels = rng.choice(args.n_tiles, args.n_labels, replace=False).tolist()
+
+    # Positions of labeled tiles in the mosaic (i.e., what `get_image`
+    # computes on every redraw).
+    t_old = timeit(lambda: [ordering.index(i) for i in labels])
+    t_new = timeit(lambda: obj.tile_rank(labels))
+    print(f'Label positions ({args.n_labels} labels, {args.n_tiles} tiles)')
+    print(f'    list.index: {t_old * 1e3:8.2f} ms')
+    print(f'    tile_rank:  {t_new * 1e3:8.2f} ms ({t_old / t_new:.0f}x)')
+
+    # Stepping through the tiles with the arrow keys
+    def step_old():
+        i = ordering[0]
+        for _ in range(args.n_steps):
+            i = ordering[ordering.index(i) + 1]
+
+    def step_new():
+        i = obj.tile_at_rank(0)
+        for _ in range(args.n_steps):
+            i = obj.tile_at_rank(obj.tile_rank(i) + 1)
+
+    t_old = timeit(step_old)
+    t_new = timeit(step_new)
+    print(f'Arrow key navigation ({args.n_steps} steps)')
+    print(f'    list.index: {t_old / args.n_steps * 1e6:8.2f} us/step')
+    print(f'    tile_rank:  {t_new / args.n_steps * 1e6:8.2f} us/step')
+
+
+if __name__ == '__main__':
+    main()
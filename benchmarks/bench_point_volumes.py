@@ -0,0 +1,73 @@
+'''
+Compare batched tile extraction against the original per-point loop.
+
+    python benchmarks/bench_point_volumes.py --n-points 2000 10000
+'''
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from synaptogram.reader import extract_tiles
+
+
+def extract_tiles_loop(image, points, size=10):
+    # This is the implementation of `BaseImarisReader.get_point_volumes` prior
+    # to batching.
+    xyz_max = image.shape[:-1]
+    volumes = []
+    lower = int(np.ceil(size / 2))
+    upper = int(np.floor(size / 2))
+    for _, point in points.iterrows():
+        i = point[['xi', 'yi', 'zi']].abs().astype('i').values
+        lb = np.clip(i - lower, 0, xyz_max)
+        ub = np.clip(i + upper, 0, xyz_max)
+        s = tuple(slice(l, u) for l, u in zip(lb, ub))
+        tile = image[s]
+        padding = size - np.array(tile.shape[:-1])
+        if np.any(padding):
+            padding = list(zip(np.zeros_like(padding), padding)) + [(0, 0)]
+            tile = np.pad(tile, padding)
+        volumes.append(tile[np.newaxis])
+    return np.concatenate(volumes, axis=0)
+
+
+def make_points(shape, n, rng):
+    xyz = rng.integers(0, shape[:-1], size=(n, 3))
+    return pd.DataFrame(xyz, columns=['xi', 'yi', 'zi'])
+
+
+def timeit(fn, *args, repeat=3):
+    result = None
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser('Benchmark tile extraction')
+    parser.add_argument('--shape', nargs=4, type=int, default=[512, 512, 64, 4])
+    parser.add_argument('--n-points', nargs='+', type=int, default=[2000, 10000])
+    parser.add_argument('--size', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 2**16, size=args.shape, dtype=np.uint16)
+
+    print(f'{"points":>8} {"loop (s)":>10} {"batched (s)":>12} {"speedup":>8}')
+    for n in args.n_points:
+        points = make_points(image.shape, n, rng)
+        t_loop, expected = timeit(extract_tiles_loop, image, points, args.size, repeat=1)
+        t_batch, actual = timeit(extract_tiles, image, points.values, args.size, repeat=args.repeat)
+        if not np.array_equal(expected, actual):
+            raise ValueError('Batched extraction does not match loop')
+        print(f'{n:>8} {t_loop:>10.3f} {t_batch:>12.3f} {t_loop / t_batch:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+'''
+Generate synthetic files with the same layout as Imaris files
+
+Only the parts of the layout that are read by `synaptogram.reader` are
+generated. Intensities are random, so the files are only useful for
+benchmarking.
+'''
+import numpy as np
+import h5py
+
+
+CHANNELS = ('GluR2', 'CtBP2', 'MyosinVIIa')
+EMISSION = (600, 500, 700)
+
+
+def _attr(value):
+    # Imaris stores attributes as arrays of single characters.
+    return np.array(list(str(value)), dtype='S1')
+
+
+def make_imaris_file(path, shape=(512, 512, 64), n_points=1000, n_levels=None,
+                     channels=CHANNELS, voxel_size=(0.1, 0.1, 0.2),
+                     chunks=(16, 128, 128), markers=('Spots 1', 'GluR2'),
+                     compression='gzip', dtype='uint8', seed=0):
+    '''
+    Create a synthetic Imaris file
+
+    Parameters
+    ----------
+    path : {str, Path}
+        File to create.
+    shape : tuple of int
+        Size of the volume (X, Y, Z) in voxels.
+    n_points : int
+        Number of spots for the first marker. Each additional marker has half
+        as many spots.
+    n_levels : {None, int}
+        Number of resolution levels. If None, levels are added until the XY
+        size drops below 256 voxels (similar to Imaris).
+    chunks : tuple of int
+        HDF5 chunk size (Z, Y, X). As with Imaris, datasets are padded to a
+        multiple of the chunk size.
+    markers : tuple of str
+        Names of the spots. Note that `ImarisReader` renames `Spots 1` to
+        `CtBP2`.
+    dtype : str
+        Integer dtype of the image (e.g., 'uint8' or 'uint16').
+    '''
+    rng = np.random.default_rng(seed)
+    max_value = np.iinfo(dtype).max
+    shape = np.asarray(shape)
+    extent = shape * np.asarray(voxel_size)
+    if n_levels is None:
+        n_levels = 1
+        while max(shape[:2]) // 2 ** n_levels >= 256:
+            n_levels += 1
+
+    with h5py.File(path, 'w') as fh:
+        image = fh.create_group('DataSetInfo/Image')
+        for i in range(3):
+            image.attrs[f'ExtMin{i}'] = _attr(0)
+            image.attrs[f'ExtMax{i}'] = _attr(extent[i])
+        for d, n in zip('XYZ', shape):
+            image.attrs[d] = _attr(n)
+        for c, name in enumerate(channels):
+            info = fh.create_group(f'DataSetInfo/Channel {c}')
+            info.attrs['Name'] = _attr(name)
+            info.attrs['LSMEmissionWavelength'] = _attr(EMISSION[c % len(EMISSION)] + c)
+
+        for level in range(n_levels):
+            level_shape = np.maximum(shape // 2 ** level, 1)[::-1]
+            level_chunks = tuple(min(c, s) for c, s in zip(chunks, level_shape))
+            padded = tuple(int(np.ceil(s / c) * c) for s, c in zip(level_shape, level_chunks))
+            for c in range(len(channels)):
+                node = fh.create_group(f'DataSet/ResolutionLevel {level}/TimePoint 0/Channel {c}')
+                for d, n in zip('ZYX', level_shape):
+                    node.attrs[f'ImageSize{d}'] = _attr(n)
+                data = node.create_dataset('Data', shape=padded, dtype=dtype,
+                                           chunks=level_chunks, compression=compression)
+                # Write one chunk of planes at a time to keep memory bounded
+                # when generating large volumes.
+                for z in range(0, padded[0], level_chunks[0]):
+                    n = min(level_chunks[0], padded[0] - z)
+                    data[z:z + n] = rng.integers(0, max_value, size=(n,) + padded[1:], dtype=dtype)
+
+        for i, name in enumerate(markers):
+            node = fh.create_group(f'Scene/Content/Points{i}')
+            node.attrs['Name'] = np.array([name.encode()])
+            n = n_points if i == 0 else n_points // 2
+            xyz = rng.uniform(0, 1, size=(n, 3)) * extent
+            radius = np.full((n, 1), 0.3)
+            node.create_dataset('CoordsXYZR', data=np.c_[xyz, radius])
+            node.create_dataset('RadiusYZ', data=np.c_[radius, radius])
+    return path
@@ -0,0 +1,206 @@
+'''
+Headless preprocessing of Imaris files
+
+Extracts the tiles for each file (populating the tile cache used by the GUI),
+computes the statistics used for sorting (and, optionally, the features used to
+suggest labels) and writes a table of the tiles for each file along with a
+summary of the time and memory used. For files with many tiles, the statistics
+can be split across worker processes that share the tiles through a
+memory-mapped file (see `synaptogram.tilestore`).
+'''
+import argparse
+from concurrent.futures import as_completed, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import glob
+import logging
+import os
+from pathlib import Path
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+
+SORT_VALUES = ('max', 'mean', 'median')
+
+
+def find_files(patterns, recursive=False):
+    files = []
+    for pattern in patterns:
+        path = Path(pattern)
+        if path.is_dir():
+            files.extend(path.glob('**/*.ims' if recursive else '*.ims'))
+        elif path.exists():
+            files.append(path)
+        else:
+            files.extend(Path(p) for p in glob.glob(pattern, recursive=recursive))
+    return sorted(set(files))
+
+
+def max_rss_mb():
+    '''
+    Peak resident memory of this process (MB) or NaN if it is not available
+    '''
+    if sys.platform == 'win32':
+        # The `resource` module is not available on Windows.
+        return float('nan')
+    import resource
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    return max_rss / (1024**2 if sys.platform == 'darwin' else 1024)
+
+
+def process_file(path, output, marker='CtBP2', size=10, sort_radius=0.5,
+                 cache_dir=None, read_workers=1, tile_dtype=None, tile_workers=1,
+                 features=False):
+    # Imports are done here to keep startup of the worker processes fast.
+    from ndimage_enaml.sphere import sphere
+    from .cache import TileCache
+    from .classify import get_features
+    from .model import masked_statistic
+    from .reader import ImarisReader
+    from .tilestore import TileStore
+
+    path = Path(path)
+    result = {'path': str(path), 'status': 'ok', 'error': ''}
+    tracemalloc.start()
+    start = t = time.perf_counter()
+
+    def checkpoint(stage):
+        nonlocal t
+        now = time.perf_counter()
+        result[f'time_{stage}'] = now - t
+        t = now
+
+    executor = None
+    try:
+        cache = TileCache(cache_dir) if cache_dir is not None else True
+        reader = ImarisReader(path, cache=cache, read_workers=read_workers,
+                              tile_dtype=tile_dtype)
+        info = reader.image_info
+        result['n_points'] = len(reader.points)
+        checkpoint('metadata')
+
+        tile_info, tiles, codec = reader.get_tiles(marker, size)
+        result['n_tiles'] = len(tiles)
+        checkpoint('tiles')
+
+        channels = [c['name'] for c in info['channels']]
+        # Tiles loaded from the cache are already in a `.npy` file that the
+        # worker processes can map. Otherwise, they are copied to a temporary
+        # file.
+        source = tiles
+        if tile_workers > 1:
+            source = TileStore.from_array(tiles, channels, codec)
+            executor = ProcessPoolExecutor(tile_workers)
+        mask = sphere(tiles.shape[1], sort_radius / info['voxel_size'][0])
+        table = tile_info.reset_index()
+        for value in SORT_VALUES:
+            stats = masked_statistic(source, mask, value, codec=codec, executor=executor)
+            for i, name in enumerate(channels + ['all']):
+                table[f'{name}_{value}'] = stats[:, i]
+        checkpoint('sort')
+
+        if features:
+            feature_table = get_features(source, tile_info, info['voxel_size'][0], channels,
+                                         codec=codec, executor=executor)
+            table = table.join(feature_table.add_prefix('feature_'))
+            checkpoint('features')
+
+        table.to_csv(Path(output) / f'{path.stem}.csv', index=False)
+        checkpoint('write')
+    except Exception as e:
+        log.exception(e)
+        result['status'] = 'failed'
+        result['error'] = str(e)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    result['time_total'] = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result['peak_allocated_mb'] = peak / 1024**2
+    result['max_rss_mb'] = max_rss_mb()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser('synaptogram batch',
+                                     description='Preprocess Imaris files without the GUI')
+    parser.add_argument('paths', nargs='+', help='Files, directories or glob patterns')
+    parser.add_argument('-o', '--output', default='.', help='Folder to save tables to')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                        help='Number of files to process at once')
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help='Search directories recursively')
+    parser.add_argument('--marker', default='CtBP2')
+    parser.add_argument('--size', type=int, default=10, help='Tile size (voxels)')
+    parser.add_argument('--sort-radius', type=float, default=0.5,
+                        help='Radius (um) used to compute the sort statistics')
+    parser.add_argument('--cache-dir', help='Tile cache folder (defaults to next to each file)')
+    parser.add_argument('--read-workers', type=int, default=1,
+                        help='Number of threads used to decompress each file')
+    parser.add_argument('--tile-dtype',
+                        help='Dtype to store tiles in (e.g., uint8). Defaults to the image dtype.')
+    parser.add_argument('--tile-workers', type=int, default=1,
+                        help='Number of processes used to compute the statistics for each file')
+    parser.add_argument('--features', action='store_true',
+                        help='Also save the features used to suggest labels')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level='INFO')
+
+    files = find_files(args.paths, args.recursive)
+    if not files:
+        parser.error('No Imaris files found')
+    output = Path(args.output)
+    output.mkdir(parents=True, exist_ok=True)
+
+    kwargs = {
+        'output': output,
+        'marker': args.marker,
+        'size': args.size,
+        'sort_radius': args.sort_radius,
+        'cache_dir': args.cache_dir,
+        'read_workers': args.read_workers,
+        'tile_dtype': args.tile_dtype,
+        'tile_workers': args.tile_workers,
+        'features': args.features,
+    }
+    results = []
+    # Use a new process for each file so that the memory usage reported for
+    # each file is not affected by the files processed before it.
+    with ProcessPoolExecutor(max_workers=args.workers, max_tasks_per_child=1) as executor:
+        futures = {executor.submit(process_file, f, **kwargs): f for f in files}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                result = future.result()
+            except BrokenProcessPool as e:
+                # The worker exited without returning (e.g., it was killed for
+                # running out of memory). Files that were still queued fail
+                # with the same error.
+                log.error('%s: worker process died: %s', path.name, e)
+                results.append({'path': str(path), 'status': 'failed',
+                                'error': f'Worker process died: {e}'})
+                continue
+            except Exception as e:
+                log.exception(e)
+                results.append({'path': str(path), 'status': 'failed', 'error': str(e)})
+                continue
+            log.info('%s: %s in %.1f s (peak %.0f MB)', Path(result['path']).name,
+                     result['status'], result['time_total'], result['max_rss_mb'])
+            results.append(result)
+
+    summary = pd.DataFrame(results).sort_values('path')
+    summary.to_csv(output / 'summary.csv', index=False)
+    n_failed = (summary['status'] != 'ok').sum()
+    log.info('Processed %d files (%d failed)', len(summary), n_failed)
+    return int(n_failed > 0)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
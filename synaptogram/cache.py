@@ -0,0 +1,154 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .tilestore import TileCodec
+
+log = logging.getLogger(__name__)
+
+
+#: Increment whenever the layout of the cached files changes so that stale
+#: entries are ignored.
+CACHE_VERSION = 3
+
+
+def frame_to_arrays(df):
+    arrays = {}
+    for i, name in enumerate(df.index.names):
+        arrays[f'index/{name}'] = np.asarray(df.index.get_level_values(i))
+    for column in df.columns:
+        arrays[f'column/{column}'] = df[column].values
+    return arrays
+
+
+def arrays_to_frame(arrays):
+    index = {k.split('/', 1)[1]: v for k, v in arrays.items() if k.startswith('index/')}
+    columns = {k.split('/', 1)[1]: v for k, v in arrays.items() if k.startswith('column/')}
+    index = pd.MultiIndex.from_arrays(list(index.values()), names=list(index.keys()))
+    if index.nlevels == 1:
+        index = index.get_level_values(0)
+    return pd.DataFrame(columns, index=index)
+
+
+class TileCache:
+    '''
+    Directory of extracted tiles keyed by source file and extraction parameters
+
+    Each entry consists of three files sharing the same name:
+
+    * `.npy` - tile array (memory-mapped when loaded)
+    * `.npz` - tile information (i.e., the table of points)
+    * `.json` - image information, the codec for the tiles (see
+      `synaptogram.tilestore.TileCodec`) and the parameters used to generate
+      the key.
+
+    When the total size of the directory exceeds `max_size` bytes, the least
+    recently used entries are removed.
+    '''
+
+    def __init__(self, directory, max_size=4 * 1024**3):
+        self.directory = Path(directory)
+        self.max_size = max_size
+
+    def get_key(self, path, **params):
+        path = Path(path)
+        stat = path.stat()
+        params = {
+            'version': CACHE_VERSION,
+            # Use the name rather than the full path so that the cache remains
+            # valid when the folder is mounted elsewhere (e.g., when the cache
+            # was populated on another computer by `synaptogram batch`).
+            'name': path.name,
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size,
+            **params,
+        }
+        digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+        return f'{path.stem}-{digest[:16]}', params
+
+    def _files(self, name):
+        return {
+            'tiles': self.directory / f'{name}.npy',
+            'tile_info': self.directory / f'{name}.npz',
+            'meta': self.directory / f'{name}.json',
+        }
+
+    def load(self, name):
+        '''
+        Load entry from the cache
+
+        Returns None if the entry is not present. Otherwise, returns a tuple of
+        the memory-mapped tiles, tile information, image information and the
+        codec for the tiles.
+        '''
+        files = self._files(name)
+        if not all(f.exists() for f in files.values()):
+            return None
+        try:
+            meta = json.loads(files['meta'].read_text())
+            with np.load(files['tile_info'], allow_pickle=False) as fh:
+                tile_info = arrays_to_frame(dict(fh))
+            tiles = np.load(files['tiles'], mmap_mode='r')
+            codec = TileCodec.from_dict(meta['codec'])
+        except Exception as e:
+            log.warning('Unable to load %s from tile cache: %s', name, e)
+            return None
+        # Used for tracking which entries were most recently used.
+        files['meta'].touch()
+        log.info('Loaded %s from tile cache', name)
+        return tiles, tile_info, meta['image_info'], codec
+
+    def save(self, name, params, tiles, tile_info, image_info, codec=None):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        files = self._files(name)
+
+        # Write to temporary files first so that an interrupted save does not
+        # leave a partial entry in the cache. The metadata file is written
+        # last since it marks the entry as complete.
+        tmp = {k: f.with_name(f'.{f.name}.tmp') for k, f in files.items()}
+        with tmp['tiles'].open('wb') as fh:
+            np.save(fh, tiles)
+        with tmp['tile_info'].open('wb') as fh:
+            np.savez(fh, **frame_to_arrays(tile_info))
+        if codec is None:
+            codec = TileCodec.identity(tiles.dtype, tiles.shape[-1])
+        meta = {'params': params, 'image_info': image_info, 'codec': codec.to_dict()}
+        tmp['meta'].write_text(json.dumps(meta, indent=4))
+        for k in ('tiles', 'tile_info', 'meta'):
+            os.replace(tmp[k], files[k])
+        log.info('Saved %s to tile cache', name)
+        self.evict(keep=name)
+
+    def entries(self):
+        '''
+        Return list of (name, size in bytes, last used) for each entry
+        '''
+        entries = []
+        for meta in self.directory.glob('*.json'):
+            files = self._files(meta.stem).values()
+            size = sum(f.stat().st_size for f in files if f.exists())
+            entries.append((meta.stem, size, meta.stat().st_mtime))
+        return entries
+
+    def remove(self, name):
+        for f in self._files(name).values():
+            f.unlink(missing_ok=True)
+
+    def evict(self, keep=None):
+        if not self.directory.exists():
+            return
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum(e[1] for e in entries)
+        for name, size, _ in entries:
+            if total <= self.max_size:
+                break
+            if name == keep:
+                continue
+            log.info('Evicting %s from tile cache', name)
+            self.remove(name)
+            total -= size
@@ -0,0 +1,306 @@
+'''
+Suggest labels for tiles using a classifier trained on previous analyses
+'''
+from functools import partial
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from ndimage_enaml.sphere import sphere
+
+from .config import CHANNEL_ALIASES
+from .state import merge_journal, read_state
+from .tilestore import map_tiles, TileCodec, TileStore
+
+log = logging.getLogger(__name__)
+
+
+#: Labels that can be suggested. Tiles without one of these labels are
+#: treated as normal ribbons.
+LABELS = ['artifact', 'orphan']
+
+
+def _feature_values(tiles, radius, batch_size=1024, codec=None):
+    n, xs, ys, zs, c = tiles.shape
+    size = tiles.shape[1]
+    core = np.flatnonzero(sphere(size, radius))
+    background = np.flatnonzero(~sphere(size, 2 * radius))
+    if len(background) == 0:
+        background = np.setdiff1d(np.arange(xs * ys * zs), core)
+    coords = np.stack(np.meshgrid(np.arange(xs), np.arange(ys), np.arange(zs), indexing='ij'), axis=-1)
+    coords = (coords - (np.array([xs, ys, zs]) - 1) / 2).reshape((-1, 3)).astype('float32')
+    r2 = (coords ** 2).sum(axis=-1)
+    pairs = [(i, j) for i in range(c) for j in range(i + 1, c)]
+    if codec is None:
+        codec = TileCodec.identity(tiles.dtype, c)
+
+    result = np.empty((n, 6 * c + len(pairs)), dtype='float32')
+    for lb in range(0, n, batch_size):
+        t = codec.decode(tiles[lb:lb+batch_size].reshape((-1, xs * ys * zs, c)), normalize=True)
+        core_voxels = t[:, core]
+        mean = core_voxels.mean(axis=1)
+        bg = t[:, background].mean(axis=1)
+        contrast = (mean - bg) / (mean + bg + 1e-6)
+
+        total = t.sum(axis=1) + 1e-6
+        centroid = np.einsum('nvc,vd->ncd', t, coords) / total[..., np.newaxis]
+        spread = np.einsum('nvc,v->nc', t, r2) / total - (centroid ** 2).sum(axis=-1)
+
+        z = t - t.mean(axis=1, keepdims=True)
+        z /= np.sqrt((z ** 2).sum(axis=1, keepdims=True)) + 1e-6
+        corr = np.einsum('nvc,nvk->nck', z, z)
+
+        result[lb:lb+batch_size] = np.concatenate([
+            mean,
+            core_voxels.max(axis=1),
+            bg,
+            contrast,
+            np.linalg.norm(centroid, axis=-1),
+            np.sqrt(np.clip(spread, 0, None)),
+            np.stack([corr[:, i, j] for i, j in pairs], axis=-1) if pairs else np.empty((len(t), 0)),
+        ], axis=-1)
+    return result
+
+
+def extract_features(tiles, radius, channel_names=None, batch_size=1024, codec=None,
+                     executor=None):
+    '''
+    Compute features describing each tile
+
+    Parameters
+    ----------
+    tiles : {array, TileStore}
+        N x X x Y x Z x C array of tiles. If a `TileStore`, the batches are
+        processed in worker processes (see `map_tiles`) and the codec
+        defaults to that of the store.
+    radius : float
+        Radius (in voxels) of the sphere around the center of the tile that
+        contains the spot. Voxels outside a sphere of twice this radius are
+        used as the background.
+    channel_names : {None, list of str}
+        Names of the channels (used to name the features).
+    batch_size : int
+        Number of tiles to process at once (limits size of temporary arrays).
+    codec : {None, TileCodec}
+        Maps the stored values to intensities (see `synaptogram.tilestore`).
+    executor : {None, ProcessPoolExecutor}
+        Worker processes used if `tiles` is a `TileStore`. If None, a new
+        pool is started.
+
+    Returns
+    -------
+    features : DataFrame
+        For each channel, the mean and max intensity within the sphere, the
+        mean intensity of the background, the contrast between the two, the
+        distance between the center of mass and the center of the tile and the
+        radius of gyration. For each pair of channels, the correlation between
+        the voxels of the tile.
+    '''
+    c = tiles.tiles.shape[-1] if isinstance(tiles, TileStore) else tiles.shape[-1]
+    if channel_names is None:
+        channel_names = [str(i) for i in range(c)]
+    names = []
+    for stat in ('mean', 'max', 'background', 'contrast', 'offset', 'spread'):
+        names.extend(f'{ch}_{stat}' for ch in channel_names)
+    names.extend(f'{channel_names[i]}_{channel_names[j]}_correlation'
+                 for i in range(c) for j in range(i + 1, c))
+
+    if isinstance(tiles, TileStore):
+        fn = partial(_feature_values, radius=radius, batch_size=batch_size,
+                     codec=tiles.codec if codec is None else codec)
+        values = map_tiles(fn, tiles, executor=executor)
+    else:
+        values = _feature_values(tiles, radius, batch_size, codec)
+    return pd.DataFrame(values, columns=names)
+
+
+def canonical_name(name):
+    '''
+    Name used for the channel (or marker) in the features (see `CHANNEL_ALIASES`)
+    '''
+    return CHANNEL_ALIASES.get(name, name)
+
+
+def get_features(tiles, tile_info, voxel_size, channel_names, radius=0.5, codec=None,
+                 executor=None):
+    '''
+    Compute features for the tiles including pairing with other markers
+
+    Features are named after the canonical channel and marker names.
+
+    Parameters
+    ----------
+    radius : float
+        Radius (um) of the spot.
+
+    See `extract_features` for the other parameters.
+    '''
+    channel_names = [canonical_name(c) for c in channel_names]
+    features = extract_features(tiles, radius / voxel_size, channel_names, codec=codec,
+                                executor=executor)
+    # Pairing with the other markers (see `synaptogram.spatial`). Distance is
+    # NaN if there are no spots within the pairing radius.
+    for column in tile_info.columns:
+        marker, _, stat = column.rpartition('_')
+        name = f'{canonical_name(marker)}_{stat}'
+        if stat == 'count':
+            features[name] = tile_info[column].values.astype('float32')
+        elif stat == 'distance':
+            features[name] = np.nan_to_num(tile_info[column].values, nan=-1).astype('float32')
+        elif column == 'orphan_candidate':
+            features[column] = tile_info[column].values.astype('float32')
+    return features
+
+
+class LabelClassifier:
+    '''
+    Multinomial logistic regression
+
+    Features are standardized and classes are weighted by their inverse
+    frequency since most tiles are not labeled. Trained using full-batch
+    gradient descent.
+    '''
+
+    def __init__(self, classes=None, l2=1e-3, n_iter=500, learning_rate=0.5):
+        self.classes = ['none'] + LABELS if classes is None else list(classes)
+        self.l2 = l2
+        self.n_iter = n_iter
+        self.learning_rate = learning_rate
+        self.feature_names = []
+        self.mean = self.std = self.weights = None
+
+    def _design_matrix(self, features):
+        missing = [n for n in self.feature_names if n not in features.columns]
+        if missing:
+            raise ValueError(f'Missing features {", ".join(missing)}. The classifier was '
+                             'trained on files with other channels or markers.')
+        x = features[self.feature_names].values
+        x = (np.nan_to_num(x) - self.mean) / self.std
+        return np.c_[x, np.ones(len(x))]
+
+    @staticmethod
+    def _softmax(z):
+        z = np.exp(z - z.max(axis=1, keepdims=True))
+        return z / z.sum(axis=1, keepdims=True)
+
+    def fit(self, features, labels):
+        labels = np.asarray(labels)
+        self.feature_names = list(features.columns)
+        x = np.nan_to_num(features.values.astype('float64'))
+        self.mean = x.mean(axis=0)
+        self.std = x.std(axis=0)
+        self.std[self.std == 0] = 1
+        x = self._design_matrix(features)
+
+        y = np.stack([labels == c for c in self.classes], axis=-1).astype('float64')
+        counts = y.sum(axis=0)
+        class_weight = np.divide(len(y), len(self.classes) * counts,
+                                 out=np.zeros_like(counts), where=counts > 0)
+        sample_weight = (y * class_weight).sum(axis=1, keepdims=True)
+        sample_weight /= sample_weight.sum()
+
+        penalty = np.ones((x.shape[1], 1))
+        penalty[-1] = 0
+        w = np.zeros((x.shape[1], len(self.classes)))
+        for _ in range(self.n_iter):
+            p = self._softmax(x @ w)
+            w -= self.learning_rate * (x.T @ (sample_weight * (p - y)) + self.l2 * penalty * w)
+        self.weights = w
+        return self
+
+    def predict_proba(self, features):
+        '''
+        Return N x K array of probabilities for each class
+        '''
+        return self._softmax(self._design_matrix(features) @ self.weights)
+
+    def predict(self, features, threshold=0.5):
+        '''
+        Return suggested label for each tile (None if no label is suggested)
+        '''
+        p = self.predict_proba(features)
+        best = p.argmax(axis=1)
+        return [self.classes[b] if self.classes[b] != 'none' and p[i, b] >= threshold else None
+                for i, b in enumerate(best)]
+
+    def save(self, path):
+        np.savez(path, classes=self.classes, feature_names=self.feature_names,
+                 mean=self.mean, std=self.std, weights=self.weights)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as fh:
+            self = cls(classes=fh['classes'].tolist())
+            self.feature_names = fh['feature_names'].tolist()
+            self.mean, self.std, self.weights = fh['mean'], fh['std'], fh['weights']
+        return self
+
+
+def get_saved_labels(state, n):
+    '''
+    Return array of labels for the tiles in a saved state
+    '''
+    labels = np.full(n, 'none', dtype=object)
+    for label, indices in state['data']['points']['labels'].items():
+        if label in LABELS:
+            labels[[int(i) for i in indices]] = label
+    return labels
+
+
+def load_training_data(paths, reader_factory=None, marker='CtBP2', size=10, radius=0.5,
+                       progress=None):
+    '''
+    Load features and labels from saved analyses
+
+    Parameters
+    ----------
+    paths : list of paths
+        Saved analyses (`.json`). The Imaris file is expected to be in the
+        same folder with the same name.
+    progress : {None, callable}
+        If provided, called with a description of each file as it is read.
+        May raise an exception to abort.
+    '''
+    if reader_factory is None:
+        from .reader import ImarisReader
+        reader_factory = ImarisReader
+    if progress is None:
+        progress = lambda stage: None
+    features, labels = [], []
+    for i, path in enumerate(paths):
+        path = Path(path)
+        progress(f'Reading {path.stem} ({i + 1} of {len(paths)})')
+        image_path = path.with_suffix('.ims')
+        if not image_path.exists():
+            log.warning('Skipping %s since %s does not exist', path, image_path.name)
+            continue
+        state = merge_journal(read_state(path))
+        # Close the file once the features are computed so that a handle is
+        # not left open for every file in the training set.
+        with reader_factory(image_path) as reader:
+            tile_info, tiles, codec = reader.get_tiles(marker, size)
+            info = reader.image_info
+            channels = [c['name'] for c in info['channels']]
+            f = get_features(tiles, tile_info, info['voxel_size'][0], channels, radius, codec)
+        if features and (different := set(f.columns) ^ set(features[0].columns)):
+            raise ValueError(f'The channels or markers in {image_path.name} do not match '
+                             f'the other files ({", ".join(sorted(different))})')
+        features.append(f)
+        labels.append(get_saved_labels(state, len(tiles)))
+    if not features:
+        raise ValueError('No saved analyses to train on')
+    return pd.concat(features, ignore_index=True), np.concatenate(labels)
+
+
+def train_classifier(paths, progress=None, **kwargs):
+    '''
+    Train classifier on the labels in saved analyses (see `load_training_data`)
+    '''
+    features, labels = load_training_data(paths, progress=progress, **kwargs)
+    if progress is not None:
+        progress('Training')
+    log.info('Training on %d tiles (%s)', len(labels),
+             ', '.join(f'{l}: {(labels == l).sum()}' for l in LABELS))
+    return LabelClassifier().fit(features, labels)
@@ -13,3 +13,22 @@ CHANNEL_CONFIG = {
     'Unknown 3': {'display_color': '#0000FF'},
     'Unknown 4': {'display_color': '#FFFFFF'},
 }
+
+
+#: Alternate spellings of channel (and marker) names. Features used to suggest
+#: labels are named after the canonical name so that files from different
+#: experiments can be used together (see `synaptogram.classify`).
+CHANNEL_ALIASES = {
+    'GlueR2': 'GluR2',
+}
+
+
+LABEL_CONFIG = {
+    'artifact': {'display_color': '#FF0000'},
+    'orphan': {'display_color': '#00FF00'},
+    'selected': {'display_color': 'white', 'border_expand': 2},
+
+    # Labels suggested by the classifier (see `synaptogram.classify`).
+    'suggested_artifact': {'display_color': '#FF0000', 'linestyle': ':'},
+    'suggested_orphan': {'display_color': '#00FF00', 'linestyle': ':'},
+}
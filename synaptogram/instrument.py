@@ -0,0 +1,153 @@
+'''
+Opt-in timing of the hot paths (reading, model updates and redraws)
+
+Instrumentation is disabled by default, in which case spans have (nearly) no
+overhead. Once enabled (e.g., via `synaptogram --profile`), the duration of
+each span is added to a rolling record of the most recent samples that can be
+summarized, logged or dumped to JSON.
+
+    from .instrument import span, timed
+
+    with span('reader.metadata'):
+        ...
+
+    @timed('model.ordering')
+    def _update_ordering(self, event=None):
+        ...
+'''
+from collections import deque
+from contextlib import contextmanager, nullcontext
+import functools
+import json
+import logging
+import threading
+import time
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+#: Edges (in ms) of the histogram bins reported in the summary.
+HISTOGRAM_EDGES = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, np.inf]
+
+
+class Timings:
+    '''
+    Rolling record of the durations of each span
+
+    Only the most recent `max_samples` durations of each span are kept.
+    Spans may be recorded from the loader threads.
+    '''
+
+    def __init__(self, max_samples=1000):
+        self.enabled = False
+        self.max_samples = max_samples
+        self.samples = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+            self.counts.clear()
+
+    def record(self, name, duration):
+        with self.lock:
+            if name not in self.samples:
+                self.samples[name] = deque(maxlen=self.max_samples)
+                self.counts[name] = 0
+            self.samples[name].append(duration)
+            self.counts[name] += 1
+
+    @contextmanager
+    def _span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def span(self, name):
+        '''
+        Context manager that records the time spent in the block
+        '''
+        if not self.enabled:
+            return nullcontext()
+        return self._span(name)
+
+    def timed(self, name):
+        '''
+        Decorator that records the time spent in the function
+        '''
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with self._span(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def get_samples(self, name):
+        '''
+        Return the recorded durations (in ms) of the span, oldest first
+        '''
+        with self.lock:
+            return np.array(self.samples.get(name, []), dtype='f') * 1e3
+
+    def summary(self, prefix=''):
+        '''
+        Summarize the spans whose name starts with `prefix`
+
+        Durations are in ms. The histogram, percentiles, mean and max are
+        computed over the samples that have been kept while `count` is the
+        total number of times the span has been recorded.
+        '''
+        with self.lock:
+            names = sorted(n for n in self.samples if n.startswith(prefix))
+        result = {}
+        for name in names:
+            samples = self.get_samples(name)
+            counts, _ = np.histogram(samples, HISTOGRAM_EDGES)
+            result[name] = {
+                'count': self.counts[name],
+                'last': float(samples[-1]),
+                'mean': float(samples.mean()),
+                'p50': float(np.percentile(samples, 50)),
+                'p95': float(np.percentile(samples, 95)),
+                'max': float(samples.max()),
+                'histogram': {
+                    'edges_ms': [float(e) for e in HISTOGRAM_EDGES],
+                    'counts': counts.tolist(),
+                },
+            }
+        return result
+
+    def format_status(self, prefix='redraw.'):
+        '''
+        One-line readout of the last and 95th percentile duration of each span
+        '''
+        parts = []
+        for name, s in self.summary(prefix).items():
+            parts.append(f'{name[len(prefix):]} {s["last"]:.0f} ms (p95 {s["p95"]:.0f} ms)')
+        return ' | '.join(parts)
+
+    def dump(self, path):
+        with open(path, 'w') as fh:
+            json.dump(self.summary(), fh, indent=4)
+
+    def log_summary(self, level=logging.INFO):
+        for name, s in self.summary().items():
+            log.log(level, '%s: n=%d, mean=%.1f ms, p50=%.1f ms, p95=%.1f ms, max=%.1f ms',
+                    name, s['count'], s['mean'], s['p50'], s['p95'], s['max'])
+
+
+#: Shared instance used by the reader, model and presenters.
+timings = Timings()
+span = timings.span
+timed = timings.timed
@@ -0,0 +1,196 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import logging
+from pathlib import Path
+import threading
+
+from atom.api import Atom, Dict, Enum, Int, List, Str, Typed, Value
+from enaml.application import deferred_call
+
+log = logging.getLogger(__name__)
+
+
+class LoadCancelled(Exception):
+    pass
+
+
+class Task(Atom):
+    '''
+    Work done in a worker thread
+
+    All attributes are updated in the GUI thread (via `deferred_call`) so that
+    it is safe to observe them from widgets.
+    '''
+    stage = Str('Queued')
+    state = Enum('queued', 'running', 'done', 'cancelled', 'failed')
+    error = Value()
+
+    #: Value returned by the work (available once state is `done`).
+    result = Value()
+
+    future = Value()
+    cancel_event = Typed(threading.Event, ())
+
+    def cancel(self):
+        self.cancel_event.set()
+        # If the task hasn't started yet, this removes it from the queue.
+        if self.future is not None and self.future.cancel():
+            self.state = 'cancelled'
+
+    def _set(self, **kwargs):
+        for k, v in kwargs.items():
+            deferred_call(setattr, self, k, v)
+
+    def report(self, stage):
+        if self.cancel_event.is_set():
+            raise LoadCancelled
+        self._set(stage=stage)
+
+    def work(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def run(self, *args, **kwargs):
+        if self.cancel_event.is_set():
+            return
+        self._set(state='running')
+        try:
+            result = self.work(*args, **kwargs)
+            self.report('Done')
+            self._set(result=result, state='done')
+        except LoadCancelled:
+            log.info('Cancelled %s', self.describe())
+            self._set(state='cancelled')
+        except Exception as e:
+            log.exception(e)
+            self._set(error=e, state='failed')
+
+    def describe(self):
+        return type(self).__name__
+
+
+class LoadTask(Task):
+    '''
+    Load of a single dataset in a worker thread
+    '''
+    path = Typed(Path)
+
+    #: Reader for the dataset. The loaded `Points` object is the result.
+    reader = Value()
+
+    def work(self, reader_factory, **kwargs):
+        self.report('Opening file')
+        reader = reader_factory(self.path)
+        result = reader.load(progress=self.report, **kwargs)
+        self._set(reader=reader)
+        return result
+
+    def describe(self):
+        return f'loading {self.path}'
+
+
+class FunctionTask(Task):
+    '''
+    Call a function in a worker thread
+
+    The function is passed a `progress` callback (see `Task.report`).
+    '''
+    description = Str()
+
+    def work(self, fn, *args, **kwargs):
+        return fn(*args, progress=self.report, **kwargs)
+
+    def describe(self):
+        return self.description
+
+
+def analyses_signature(paths):
+    # Modification times of saved analyses (including their journals) used to
+    # check whether a cached classifier is out of date.
+    from .state import journal_path
+    signature = []
+    for path in sorted(Path(p) for p in paths):
+        journal = journal_path(path)
+        mtime = journal.stat().st_mtime_ns if journal.exists() else 0
+        signature.append((str(path), path.stat().st_mtime_ns, mtime))
+    return tuple(signature)
+
+
+def imaris_reader(path, **kwargs):
+    # The reader pulls in h5py, pandas and the model, which are slow to
+    # import. Importing it here (i.e., in the worker thread) keeps the window
+    # responsive while they load.
+    from .reader import ImarisReader
+    return ImarisReader(path, **kwargs)
+
+
+class DatasetLoader(Atom):
+    '''
+    Loads datasets (and runs other slow work) in a pool of worker threads
+    '''
+    #: Number of datasets that can be loaded at once. Additional datasets are
+    #: queued.
+    max_workers = Int(2)
+
+    #: Keyword arguments passed to `ImarisReader` (e.g., `read_workers`).
+    reader_options = Dict()
+
+    #: Classifiers trained on the saved analyses in a folder keyed by the
+    #: analyses used for training (see `get_classifier`).
+    classifiers = Dict()
+
+    #: Tasks that have been submitted and have not finished (see `shutdown`).
+    tasks = List()
+
+    executor = Typed(ThreadPoolExecutor)
+
+    def _default_executor(self):
+        return ThreadPoolExecutor(max_workers=self.max_workers,
+                                  thread_name_prefix='synaptogram-loader')
+
+    def submit(self, path, reader_factory=None, **kwargs):
+        if reader_factory is None:
+            reader_factory = partial(imaris_reader, **self.reader_options)
+        task = LoadTask(path=Path(path))
+        return self._submit(task, reader_factory, **kwargs)
+
+    def submit_call(self, description, fn, *args, **kwargs):
+        '''
+        Call `fn` in a worker thread (see `FunctionTask`)
+        '''
+        task = FunctionTask(description=description)
+        return self._submit(task, fn, *args, **kwargs)
+
+    def _submit(self, task, *args, **kwargs):
+        task.future = self.executor.submit(task.run, *args, **kwargs)
+        self.tasks = [t for t in self.tasks if not t.future.done()] + [task]
+        return task
+
+    def get_classifier(self, paths, reader_factory=None, progress=None):
+        '''
+        Return classifier trained on the saved analyses
+
+        The classifier is cached and only trained again if the analyses were
+        saved since. Training is slow (each Imaris file is opened), so call
+        this from a worker thread.
+        '''
+        from .classify import train_classifier
+        key = tuple(sorted(str(p) for p in paths))
+        signature = analyses_signature(paths)
+        if (cached := self.classifiers.get(key)) is not None and cached[0] == signature:
+            return cached[1]
+        if reader_factory is None:
+            reader_factory = partial(imaris_reader, **self.reader_options)
+        classifier = train_classifier(paths, reader_factory=reader_factory, progress=progress)
+        self.classifiers[key] = (signature, classifier)
+        return classifier
+
+    def shutdown(self):
+        '''
+        Cancel the queued and running tasks and stop the worker threads
+
+        Running tasks stop at their next progress report (see `Task.report`).
+        '''
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        self.executor.shutdown(wait=False, cancel_futures=True)
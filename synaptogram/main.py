@@ -1,14 +1,12 @@
-
 import argparse
 import configparser
 import logging
 from pathlib import Path
-
-from enaml.application import deferred_call
-from enaml.qt.QtCore import QStandardPaths
+import sys
 
 
 def config_file():
+    from enaml.qt.QtCore import QStandardPaths
     config_path = Path(QStandardPaths.standardLocations(QStandardPaths.AppConfigLocation)[0])
     config_file =  config_path / 'synaptogram' / 'config.ini'
     config_file.parent.mkdir(exist_ok=True, parents=True)
@@ -27,25 +25,68 @@ def write_config(config):
         config.write(fh)
 
 
-def main():
+def import_gui():
+    '''
+    Import the modules needed to show the main window
+
+    The modules needed to open a dataset (e.g., the reader and presenters) are
+    imported when the first dataset is opened. See
+    `benchmarks/bench_import.py` for the time spent importing each module.
+    '''
     import enaml
     from enaml.qt.qt_application import QtApplication
-    logging.basicConfig(level='INFO')
-
-    from synaptogram.presenter import SynaptogramPresenter
-    from synaptogram.reader import ImarisReader
     with enaml.imports():
         from synaptogram.gui import load_dataset, SynaptogramWindow
+    return QtApplication, SynaptogramWindow, load_dataset
+
 
-    parser = argparse.ArgumentParser("Synaptogram helper")
+def main():
+    if sys.argv[1:2] == ['batch']:
+        from synaptogram.batch import main as batch_main
+        return batch_main(sys.argv[2:])
+
+    parser = argparse.ArgumentParser("Synaptogram helper",
+                                     epilog="Run `synaptogram batch --help` for headless preprocessing.")
     parser.add_argument("path", nargs='?')
+    parser.add_argument("--profile", action='store_true',
+                        help="Record the time spent reading, updating and redrawing")
+    parser.add_argument("--profile-output",
+                        help="Save the timing summary (JSON) to this file on exit")
+    parser.add_argument("--read-workers", type=int,
+                        help="Number of threads used to decompress the image "
+                        "(default is the number of CPUs, up to 8)")
+    parser.add_argument("--tile-dtype",
+                        help="Dtype to store the tiles in (e.g., uint8). Defaults "
+                        "to the dtype of the image.")
+    parser.add_argument("--tile-workers", type=int,
+                        help="Number of processes used to sort large tile sets "
+                        "(default is to sort in the main process)")
     args = parser.parse_args()
+    logging.basicConfig(level='INFO')
+
+    from enaml.application import deferred_call
+    from synaptogram.instrument import timings
+    from synaptogram.loader import DatasetLoader
+    QtApplication, SynaptogramWindow, load_dataset = import_gui()
+
+    reader_options = {}
+    if args.read_workers is not None:
+        reader_options['read_workers'] = args.read_workers
+    if args.tile_dtype is not None:
+        reader_options['tile_dtype'] = args.tile_dtype
+    if args.tile_workers is not None:
+        reader_options['tile_workers'] = args.tile_workers
+
+    if args.profile or args.profile_output:
+        timings.enable()
 
     app = QtApplication()
     config = get_config()
 
     view = SynaptogramWindow(
             current_path=config['DEFAULT']['current_path'],
+            show_timings=timings.enabled,
+            loader=DatasetLoader(reader_options=reader_options),
     )
     if args.path is not None:
         deferred_call(load_dataset, args.path, view)
@@ -56,6 +97,11 @@ def main():
     config['DEFAULT']['current_path'] = str(Path(view.current_path).absolute())
     write_config(config)
 
+    if timings.enabled:
+        timings.log_summary()
+        if args.profile_output:
+            timings.dump(args.profile_output)
+
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -1,14 +1,187 @@
+from functools import partial
+
+from matplotlib import colors
 from matplotlib import transforms as T
 import numpy as np
 import pandas as pd
 
-from atom.api import Atom, Dict, Enum, Event, Float, Int, Str, Typed, Value, observe
+from atom.api import Atom, Bool, Callable, Dict, Enum, Event, Float, Int, List, Str, Typed, Value, observe
 
 from ndimage_enaml.model import get_channel_config, make_channel_config, NDImage
-from ndimage_enaml.util import get_image, tile_images
 from ndimage_enaml.sphere import sphere
 
+from synaptogram.classify import get_features, LABELS
 from synaptogram.config import CHANNEL_CONFIG
+from synaptogram.instrument import span, timed
+from synaptogram.state import is_saved_label
+from synaptogram.tilestore import map_tiles, shared_executor, TileCodec, TileStore
+
+
+def masked_statistic(tiles, mask, statistic, batch_size=4096, codec=None, executor=None):
+    '''
+    Compute statistic over the voxels of each tile that fall within the mask
+
+    Parameters
+    ----------
+    tiles : {array, TileStore}
+        N x X x Y x Z x C array of tiles. If a `TileStore`, the batches are
+        processed in worker processes (see `map_tiles`) and the codec
+        defaults to that of the store.
+    mask : array
+        X x Y x Z boolean mask.
+    statistic : {'max', 'mean', 'median'}
+        Name of the NumPy function used to reduce the voxels.
+    batch_size : int
+        Number of tiles to process at once (limits size of temporary arrays).
+    codec : {None, TileCodec}
+        If the tiles are stored in a compact dtype, used to convert the voxels
+        to intensities.
+    executor : {None, ProcessPoolExecutor}
+        Worker processes used if `tiles` is a `TileStore`. If None, a new
+        pool is started.
+
+    Returns
+    -------
+    result : array
+        N x (C + 1) array. The first C columns are the statistic for each
+        channel. The last column is the statistic across all channels.
+    '''
+    if isinstance(tiles, TileStore):
+        fn = partial(masked_statistic, mask=mask, statistic=statistic,
+                     batch_size=batch_size, codec=tiles.codec if codec is None else codec)
+        return map_tiles(fn, tiles, batch_size, executor=executor)
+    fn = getattr(np, statistic)
+    n, c = len(tiles), tiles.shape[-1]
+    i = np.flatnonzero(mask)
+    result = np.empty((n, c + 1))
+    for lb in range(0, n, batch_size):
+        # Fancy indexing only copies the voxels within the mask.
+        voxels = tiles[lb:lb+batch_size].reshape((-1, mask.size, c))[:, i]
+        if codec is None or codec.is_identity:
+            result[lb:lb+batch_size, :c] = fn(voxels, axis=1)
+            result[lb:lb+batch_size, c] = fn(voxels.reshape((len(voxels), -1)), axis=1)
+            continue
+        # The stored values increase linearly with the intensity, so the
+        # statistic for each channel can be converted after reducing rather
+        # than converting every voxel. This does not hold for the median
+        # across channels since each channel has its own scale.
+        stats = codec.decode(fn(voxels, axis=1))
+        result[lb:lb+batch_size, :c] = stats
+        if statistic == 'median':
+            all_voxels = codec.decode(voxels).reshape((len(voxels), -1))
+            result[lb:lb+batch_size, c] = fn(all_voxels, axis=1)
+        else:
+            result[lb:lb+batch_size, c] = fn(stats, axis=1)
+    return result
+
+
+def normalize_channels(image, img_max):
+    '''
+    Divide each channel by its maximum and clip to the range 0 to 1 (float32)
+    '''
+    image = np.divide(image, img_max.astype('float32'),
+                      out=np.zeros(image.shape, dtype='float32'), where=img_max != 0)
+    np.clip(image, 0, 1, out=image)
+    return image
+
+
+def color_channels(image, channel_config):
+    '''
+    Float32 version of `ndimage_enaml.util.color_image`
+
+    Maps the channels in the last axis of the normalized image to RGB.
+    '''
+    rgb_image = np.zeros(image.shape[:-1] + (3,), dtype='float32')
+    for config in channel_config:
+        if not config.get('visible', True):
+            continue
+        rgb = np.array(colors.to_rgb(config['display_color']), dtype='float32')
+        lb = config.get('min_value', 0)
+        ub = config.get('max_value', 1)
+        d = image[..., config['i']] - np.float32(lb)
+        d /= np.float32(ub - lb)
+        np.clip(d, 0, 1, out=d)
+        np.maximum(rgb_image, d[..., np.newaxis] * rgb, out=rgb_image)
+    return rgb_image
+
+
+def tile_mosaic(images, n_cols, padding=1):
+    '''
+    Float32 version of `ndimage_enaml.util.tile_images`
+
+    Arranges the N x X x Y x 3 images in a grid with `n_cols` columns.
+    '''
+    n, xs, ys, c = images.shape
+    n_rows = int(np.ceil(n / n_cols))
+    p = padding
+    padded = np.zeros((n_rows * n_cols, xs + p, ys + p, c), dtype='float32')
+    padded[:n, :xs, :ys] = images
+    mosaic = np.zeros(((xs + p) * n_cols + p, (ys + p) * n_rows + p, c), dtype='float32')
+    mosaic[p:, p:] = padded.reshape((n_rows, n_cols, xs + p, ys + p, c)) \
+        .transpose(1, 2, 0, 3, 4).reshape((n_cols * (xs + p), n_rows * (ys + p), c))
+    return mosaic
+
+
+def project_tiles(tiles, channel_config, padding=1, codec=None):
+    '''
+    Orthogonal projections of a batch of tiles
+
+    Vectorized version of `ndimage_enaml.util.project_image` (with the same
+    layout) that returns N x Y x X x 3 uint8 RGB images.
+    '''
+    n, xs, ys, zs, cs = tiles.shape
+    if codec is None:
+        codec = TileCodec.identity(tiles.dtype, cs)
+    # The maximum is taken before converting the stored values to intensities
+    # (the conversion preserves the order of values).
+    project = lambda axis: codec.decode(tiles.max(axis=axis), normalize=True)
+    x_proj, y_proj, z_proj = project(1), project(2), project(3)
+
+    # Each channel is projected into its own panel.
+    p = padding
+    panel = xs + ys + p * 2
+    image = np.zeros((n, panel * cs + p, xs + ys + p * 3, cs), dtype='float32')
+    for c in range(cs):
+        o = c * panel + p
+        image[:, o:o+xs, p:p+ys, c] = z_proj[..., c]
+        image[:, o+xs+p:o+xs+p+zs, p:p+ys, c] = x_proj[..., c].swapaxes(1, 2)
+        image[:, o:o+xs, ys+p*2:ys+p*2+zs, c] = y_proj[..., c]
+
+    rgb_image = color_channels(image, channel_config)
+    rgb_image = (rgb_image * 255).round().astype('uint8')
+    return rgb_image.swapaxes(1, 2)
+
+
+class TileArrayCache:
+    '''
+    Per-tile array that is computed lazily as tiles are requested
+    '''
+    def __init__(self, n, shape, dtype='float32'):
+        # Memory is not committed until the tiles are computed.
+        self.data = np.empty((n,) + tuple(shape), dtype=dtype)
+        self.filled = np.zeros(n, dtype=bool)
+
+    def get(self, indices, compute):
+        '''
+        Return cached values for tiles, calling `compute` for missing tiles
+        '''
+        indices = np.asarray(indices, dtype=int)
+        missing = np.unique(indices[~self.filled[indices]])
+        if len(missing):
+            self.data[missing] = compute(missing)
+            self.filled[missing] = True
+        return self.data[indices]
+
+
+def _cache_get(cache, key, factory, max_size):
+    # Simple LRU for dictionaries (which maintain insertion order).
+    if key in cache:
+        cache[key] = cache.pop(key)
+    else:
+        cache[key] = factory()
+        while len(cache) > max_size:
+            cache.pop(next(iter(cache)))
+    return cache[key]
 
 
 class TiledNDImage(Atom):
@@ -18,45 +191,289 @@ class TiledNDImage(Atom):
     info = Dict()
     tile_info = Typed(pd.DataFrame)
     tiles = Typed(np.ndarray)
+
+    #: Maps the values stored in `tiles` to intensities (see
+    #: `synaptogram.tilestore.TileCodec`).
+    codec = Typed(TileCodec)
+
     n_cols = Int(12)
     padding = Int(3)
 
     sort_channel = Str()
     sort_value = Enum('max', 'mean', 'median')
     sort_radius = Float(0.5)
-    ordering = Value()
 
+    #: Tile indices in display order (i.e., `ordering[rank]` is the tile shown
+    #: at that position in the mosaic).
+    ordering = Typed(np.ndarray)
+
+    #: Inverse of `ordering` (i.e., `ranks[i]` is the position of tile `i` in
+    #: the mosaic).
+    ranks = Typed(np.ndarray)
+
+    #: Cache of statistics used for sorting keyed by (sort_value, sort_radius).
+    #: See `masked_statistic`.
+    sort_statistics = Dict()
+
+    #: Mapping of label to the set of tile indices with that label.
     labels = Dict()
     channel_config = Dict()
     labels_updated = Event()
 
-    def __init__(self, info, tile_info, tiles, **kwargs):
-        super().__init__(info=info, tile_info=tile_info, tiles=tiles, **kwargs)
+    #: Number of edits made to the saved labels. Used to check for unsaved
+    #: changes without comparing the labels.
+    edit_count = Int(0)
+
+    #: Edits made to the saved labels that have not been saved yet (see
+    #: `synaptogram.state`).
+    pending_edits = List()
+
+    #: If False, tiles cannot be labeled (e.g., tiles for a marker other than
+    #: the one being analyzed).
+    editable = Bool(True)
+
+    #: Features used to suggest labels (see `synaptogram.classify`).
+    features = Typed(pd.DataFrame)
+
+    #: Number of worker processes used to compute the sort statistics and
+    #: features once there are at least `min_mapped_tiles` tiles. If 0, they
+    #: are computed in this process.
+    tile_workers = Int(0)
+    min_mapped_tiles = Int(20000)
+
+    #: Tiles in a memory-mapped file that the worker processes attach to (see
+    #: `synaptogram.tilestore`). Created on first use.
+    tile_store = Typed(TileStore)
+
+    #: Cache of the per-channel values used to normalize the tiles keyed by
+    #: (axis, norm_percentile).
+    tile_norm = Dict()
+
+    #: Cache of normalized projections of the tiles keyed by (z_slice, axis,
+    #: norm_percentile).
+    projection_cache = Dict()
+
+    #: Cache of colored projections of each channel keyed by the channel
+    #: display settings and the projection key.
+    layer_cache = Dict()
+
+    #: Maximum number of entries in the projection and layer caches. Older
+    #: entries are discarded (e.g., as the user adjusts the contrast).
+    max_cached_projections = Int(4)
+    max_cached_layers = Int(16)
+
+    #: Cache of the orthogonal projections of the tiles (see `project_tiles`)
+    #: keyed by the channel display settings.
+    point_projection_cache = Dict()
+    max_cached_point_projections = Int(4)
+
+    def __init__(self, info, tile_info, tiles, codec=None, **kwargs):
+        if codec is None:
+            codec = TileCodec.identity(tiles.dtype, tiles.shape[-1])
+        super().__init__(info=info, tile_info=tile_info, tiles=tiles, codec=codec, **kwargs)
         self.channel_config = make_channel_config(info, CHANNEL_CONFIG)
         self._update_ordering()
 
+    def get_tile_store(self):
+        if self.tile_store is None:
+            self.tile_store = TileStore.from_array(self.tiles, self.channel_names, self.codec)
+            # Use the mapped tiles so that they are not held in memory twice.
+            self.tiles = self.tile_store.tiles
+        return self.tile_store
+
+    def _tile_source(self):
+        # Tiles (or the tile store and the pool of workers that attach to it)
+        # used to compute the sort statistics and features.
+        if self.tile_workers > 0 and len(self.tiles) >= self.min_mapped_tiles:
+            return self.get_tile_store(), shared_executor(self.tile_workers)
+        return self.tiles, None
+
+    @timed('model.sort_statistics')
+    def get_sort_statistics(self, value, radius):
+        key = (value, radius)
+        if key not in self.sort_statistics:
+            mask = sphere(self.tiles.shape[1], radius / self.get_voxel_size('x'))
+            tiles, executor = self._tile_source()
+            self.sort_statistics[key] = masked_statistic(tiles, mask, value, codec=self.codec,
+                                                         executor=executor)
+        return self.sort_statistics[key]
+
     @observe('sort_channel', 'sort_value', 'sort_radius')
+    @timed('model.ordering')
     def _update_ordering(self, event=None):
-        template = sphere(self.tiles.shape[1:-1], self.sort_radius / self.get_voxel_size('x'))
-        fn = getattr(np, self.sort_value)
-        if self.sort_channel:
-            c = self.channel_names.index(self.sort_channel)
-            tiles = self.tiles[..., c] * template
-            self.ordering = fn(tiles, axis=(1, 2, 3)).argsort().tolist()
-        else:
-            tiles = self.tiles * template[..., np.newaxis]
-            self.ordering = fn(tiles, axis=(1, 2, 3, 4)).argsort().tolist()
+        stats = self.get_sort_statistics(self.sort_value, self.sort_radius)
+        c = self.channel_names.index(self.sort_channel) if self.sort_channel else -1
+        ordering = stats[:, c].argsort()
+        ranks = np.empty_like(ordering)
+        ranks[ordering] = np.arange(len(ordering))
+        self.ranks = ranks
+        self.ordering = ordering
+
+    def tile_rank(self, i):
+        '''
+        Position of tile(s) `i` in the mosaic
+        '''
+        return self.ranks[i]
+
+    def tile_at_rank(self, rank):
+        '''
+        Index of tile(s) shown at position `rank` in the mosaic
+        '''
+        return self.ordering[rank]
 
     def get_channel_config(self, channels=None):
         if channels is None:
             channels = self.channel_names
         return get_channel_config(channels, self.channel_config)
 
-    def get_image(self, channels, *args, **kwargs):
+    def get_tile_norm(self, axis='z', norm_percentile=99):
+        # This is the same normalization used by `ndimage_enaml.util.get_image`.
+        # It is computed across all tiles so that the brightness of a tile
+        # does not depend on which tiles are rendered.
+        key = (axis, norm_percentile)
+        if key not in self.tile_norm:
+            ai = 'xyz'.index(axis) + 1
+            projection = self.tiles.max(axis=ai)
+            norm = np.percentile(projection, norm_percentile, axis=(0, 1, 2))
+            self.tile_norm[key] = self.codec.decode(norm)
+        return self.tile_norm[key]
+
+    def _project_tiles(self, indices, z_slice, axis, norm_percentile):
+        img_max = self.get_tile_norm(axis, norm_percentile)
+        ai = 'xyz'.index(axis) + 1
+        image = self.tiles[indices]
+        if z_slice is not None:
+            s = [slice(None)] * image.ndim
+            s[ai] = z_slice
+            image = image[tuple(s)]
+        image = self.codec.decode(image.max(axis=ai))
+        return np.divide(image, img_max, out=np.zeros(image.shape, dtype='float32'),
+                         where=img_max != 0).clip(0, 1)
+
+    @timed('model.render_tiles')
+    def render_tiles(self, indices, channel_config, z_slice=None, axis='z',
+                     norm_percentile=99):
+        '''
+        Return RGB projections of the tiles
+
+        Each channel is colored separately and cached so that only channels
+        whose display settings changed need to be rendered again.
+        '''
+        if isinstance(z_slice, slice):
+            z_key = (z_slice.start, z_slice.stop, z_slice.step)
+        else:
+            z_key = z_slice
+        p_key = (z_key, axis, norm_percentile)
+        n = len(self.tiles)
+        shape = [s for i, s in enumerate(self.tiles.shape[1:-1]) if i != 'xyz'.index(axis)]
+
+        projection = _cache_get(
+            self.projection_cache, p_key,
+            lambda: TileArrayCache(n, shape + [self.tiles.shape[-1]]),
+            self.max_cached_projections)
+        project = lambda i: self._project_tiles(i, z_slice, axis, norm_percentile)
+
+        # Start with a blank image so we still return something if no channels
+        # are visible.
+        image = np.zeros((len(indices), *shape, 3), dtype='float32')
+        for config in channel_config:
+            if not config.get('visible', True):
+                continue
+            rgb = colors.to_rgb(config['display_color'])
+            lb = config.get('min_value', 0)
+            ub = config.get('max_value', 1)
+            c = config['i']
+            key = (c, rgb, lb, ub) + p_key
+
+            def render(i):
+                d = np.clip((projection.get(i, project)[..., c] - lb) / (ub - lb), 0, 1)
+                return d[..., np.newaxis] * np.array(rgb, dtype='float32')
+
+            layer = _cache_get(self.layer_cache, key,
+                               lambda: TileArrayCache(n, shape + [3]),
+                               self.max_cached_layers)
+            np.maximum(image, layer.get(indices, render), out=image)
+        return image
+
+    @timed('model.point_projections')
+    def get_point_projections(self, indices, channel_config, padding=1):
+        '''
+        Return orthogonal projections of the tiles as uint8 RGB images
+
+        Projections are cached for each set of channel display settings.
+        '''
+        key = tuple((c['i'], colors.to_rgb(c['display_color']),
+                     c.get('min_value', 0), c.get('max_value', 1))
+                    for c in channel_config if c.get('visible', True))
+        key += (padding,)
+        n, xs, ys, zs, cs = self.tiles.shape
+        shape = (xs + ys + padding * 3, (xs + ys + padding * 2) * cs + padding, 3)
+        cache = _cache_get(self.point_projection_cache, key,
+                           lambda: TileArrayCache(n, shape, dtype='uint8'),
+                           self.max_cached_point_projections)
+        return cache.get(indices, lambda i: project_tiles(self.tiles[i], channel_config,
+                                                          padding, self.codec))
+
+    def get_image(self, channels, z_slice=None, axis='z', norm_percentile=99,
+                  rows=None):
+        '''
+        Return mosaic of tiles
+
+        If `rows` (a tuple of first and last row) is provided, only the tiles
+        in those rows are rendered. See `get_rows_extent` for the extent of the
+        resulting image. Labels are not included (see `get_label_extents`).
+        '''
+        r0, r1 = (0, self.n_rows) if rows is None else rows
+        ranks = np.arange(r0 * self.n_cols, min(r1 * self.n_cols, len(self.tiles)))
         channel_config = self.get_channel_config(channels)
-        images = get_image(self.tiles, channel_config, *args, **kwargs)
-        labels = {l: [self.ordering.index(i) for i in s] for l, s in self.labels.items()}
-        return tile_images(images[self.ordering], self.n_cols, self.padding, labels)
+        images = self.render_tiles(self.tile_at_rank(ranks), channel_config,
+                                   z_slice, axis, norm_percentile)
+        with span('model.tile_images'):
+            return tile_mosaic(images, self.n_cols, self.padding)
+
+    def get_label_extents(self):
+        '''
+        Return extents of the labeled tiles in the mosaic
+
+        Returns a dictionary mapping each label to an N x 4 array of tile
+        extents (xlb, xub, ylb, yub).
+        '''
+        extents = {}
+        for label, indices in self.labels.items():
+            extent = self.get_tile_extent(np.fromiter(indices, dtype=int))
+            extents[label] = np.column_stack(extent)
+        return extents
+
+    @property
+    def n_rows(self):
+        return int(np.ceil(len(self.tiles) / self.n_cols))
+
+    def get_row_range(self, ylb, yub):
+        '''
+        Return first and last row of tiles that intersect the y-range
+        '''
+        ys = self.tiles.shape[2] + self.padding
+        r0 = int(np.floor((ylb - self.padding) / ys))
+        r1 = int(np.ceil(yub / ys))
+        return int(np.clip(r0, 0, self.n_rows)), int(np.clip(r1, 0, self.n_rows))
+
+    def get_rows_extent(self, r0, r1):
+        '''
+        Return extent of the image returned by `get_image` for the rows
+        '''
+        ys = self.tiles.shape[2] + self.padding
+        x_size = self.get_image_extent()[1]
+        return (0, x_size, r0 * ys, r1 * ys + self.padding)
+
+    def get_tile_extent(self, i):
+        '''
+        Return extent of tile(s) `i` in the mosaic
+        '''
+        rank = self.tile_rank(i)
+        xs, ys = self.tiles.shape[1:3]
+        xlb = (xs + self.padding) * (rank % self.n_cols) + self.padding
+        ylb = (ys + self.padding) * (rank // self.n_cols) + self.padding
+        return (xlb, xlb + xs, ylb, ylb + ys)
 
     @property
     def z_slice_max(self):
@@ -70,11 +487,9 @@ class TiledNDImage(Atom):
         return self.info['voxel_size']['xyz'.index(dim)]
 
     def get_image_extent(self):
-        n = len(self.tiles)
-        n_rows = int(np.ceil(n / self.n_cols))
         xs, ys = self.tiles.shape[1:3]
         x_size = (xs + self.padding) * self.n_cols + self.padding
-        y_size = (ys + self.padding) * n_rows + self.padding
+        y_size = (ys + self.padding) * self.n_rows + self.padding
         return (0, x_size, 0, y_size)
 
     def get_image_transform(self):
@@ -89,36 +504,89 @@ class TiledNDImage(Atom):
         if (xi < 0) or (yi < 0):
             return -1
         if (i := yi * self.n_cols + xi) < len(self.tiles):
-            i = int(i)
-            return self.ordering[i]
+            return int(self.tile_at_rank(int(i)))
         return -1
 
+    def get_neighbors(self, i, n):
+        '''
+        Return the tiles within `n` positions of tile `i` in the mosaic
+        '''
+        rank = self.tile_rank(i)
+        return self.ordering[max(rank - n, 0):rank + n + 1]
+
     def select_next_tile(self, i, step):
-        j = self.ordering.index(i) + step
+        j = self.tile_rank(i) + step
         if not (0 <= j < len(self.ordering)):
             return self._select_tile(i)
-        return self._select_tile(self.ordering[j])
+        return self._select_tile(int(self.tile_at_rank(j)))
+
+    def _record_edit(self, op, label, i):
+        if is_saved_label(label):
+            self.pending_edits.append((op, label, i))
+            self.edit_count += 1
 
     def label_tile(self, i, label):
-        if i == -1:
+        if i == -1 or not self.editable:
+            return
+        indices = self.labels.setdefault(label, set())
+        if i in indices:
             return
-        self.labels.setdefault(label, {})[i] = self.tile_info.iloc[i].to_dict()
+        indices.add(i)
+        self._record_edit('add', label, i)
         self.labels_updated = True
 
     def unlabel_tile(self, i, label=None):
-        if i == -1:
+        if i == -1 or not self.editable:
             return
-        if label is None:
-            for l, indices in self.labels.items():
-                if l == 'selected':
-                    continue
-                if i in indices:
-                    del indices[i]
-        else:
-            if i in self.labels[label]:
-                del self.labels[i]
+        labels = self.labels.keys() if label is None else [label]
+        changed = False
+        for l in labels:
+            if l == 'selected':
+                continue
+            indices = self.labels.get(l, set())
+            if i in indices:
+                indices.discard(i)
+                self._record_edit('remove', l, i)
+                changed = True
+        if changed:
+            self.labels_updated = True
+
+    def clear_edits(self):
+        '''
+        Discard the pending edits once they have been saved
+        '''
+        self.pending_edits = []
+
+    def get_features(self):
+        if self.features is None:
+            tiles, executor = self._tile_source()
+            self.features = get_features(tiles, self.tile_info,
+                                         self.get_voxel_size('x'),
+                                         self.channel_names, codec=self.codec,
+                                         executor=executor)
+        return self.features
+
+    def suggest_labels(self, classifier, threshold=0.5):
+        '''
+        Suggest labels for the tiles that have not been labeled
+
+        Suggestions are stored as `suggested_{label}` and are not saved. They
+        are removed when the tile is labeled.
+        '''
+        predicted = classifier.predict(self.get_features(), threshold)
+        labeled = set().union(*(self.labels.get(l, set()) for l in LABELS))
+        for label in LABELS:
+            self.labels[f'suggested_{label}'] = \
+                {i for i, p in enumerate(predicted) if p == label and i not in labeled}
         self.labels_updated = True
 
+    def accept_suggestion(self, i):
+        for label in LABELS:
+            if i in self.labels.get(f'suggested_{label}', set()):
+                self.unlabel_tile(i)
+                self.label_tile(i, label)
+                return
+
     def select_tile_by_coords(self, x, y):
         i = self.tile_index(x, y)
         if i == -1:
@@ -127,30 +595,307 @@ class TiledNDImage(Atom):
 
     def _select_tile(self,  i):
         info = self.tile_info.iloc[i].to_dict()
-        self.labels['selected'] = {i: info}
+        self.labels['selected'] = {i}
         info['i'] = i
         return info
 
     def get_state(self):
-        labels = {l: i for l, i in self.labels.items() if l != 'selected'}
+        labels = {l: sorted(i) for l, i in self.labels.items() if is_saved_label(l)}
         return {
             'labels': labels,
         }
 
     def set_state(self, state):
-        for label, indices in state['labels'].items():
-            indices = {int(k): v for k, v in indices.items()}
-            self.labels[label] = indices
+        # Older analyses saved the tile information for each label (i.e., a
+        # dictionary keyed by the tile index).
+        labels = {l: {int(i) for i in indices} for l, indices in state['labels'].items()}
+        for label in [l for l in self.labels if is_saved_label(l)]:
+            if label not in labels:
+                del self.labels[label]
+        self.labels.update(labels)
+        self.pending_edits = []
+        self.labels_updated = True
+
+
+class SubstackCache:
+    '''
+    Maximum projections of z-substacks assembled from cached blocks
+
+    The volume is divided into columns of `block_size` x `block_size` voxels
+    spanning the full stack. For each column, `runs[k][:, :, z]` is the
+    maximum over the `2 ** k` planes starting at `z` (i.e., a sparse table).
+    The projection of any substack [lb, ub) is then the maximum of two runs
+    (starting at `lb` and ending at `ub`), so the cost of a projection does
+    not depend on the position or thickness of the substack. A column is read
+    from the volume once, the first time it is needed. Columns are discarded
+    (least recently used first) once the cache exceeds `max_bytes`.
+    '''
+    def __init__(self, volume, block_size=128, max_bytes=512 * 1024**2):
+        self.volume = volume
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self.blocks = {}
+        self.nbytes = 0
+
+    def _get_runs(self, bx, by, k):
+        key = (bx, by)
+        if key in self.blocks:
+            runs = self.blocks[key] = self.blocks.pop(key)
+        else:
+            b = self.block_size
+            runs = self.blocks[key] = [np.asarray(self.volume[bx*b:(bx+1)*b, by*b:(by+1)*b])]
+            self.nbytes += runs[0].nbytes
+        while len(runs) <= k:
+            n = 1 << (len(runs) - 1)
+            runs.append(np.maximum(runs[-1][:, :, :-n], runs[-1][:, :, n:]))
+            self.nbytes += runs[-1].nbytes
+        while self.nbytes > self.max_bytes and len(self.blocks) > 1:
+            oldest = next(iter(self.blocks))
+            self.nbytes -= sum(r.nbytes for r in self.blocks.pop(oldest))
+        return runs[k]
+
+    def project(self, xs, ys, zs):
+        '''
+        Return maximum projection of `volume[xs, ys, zs]` along z
+        '''
+        nx, ny, nz, nc = self.volume.shape
+        xlb, xub, _ = xs.indices(nx)
+        ylb, yub, _ = ys.indices(ny)
+        zlb, zub, _ = zs.indices(nz)
+        zlb = min(zlb, zub - 1)
+        k = (zub - zlb).bit_length() - 1
+        b = self.block_size
+        image = np.empty((xub - xlb, yub - ylb, nc), dtype=self.volume.dtype)
+        for bx in range(xlb // b, (xub - 1) // b + 1):
+            x0, x1 = max(xlb, bx * b), min(xub, (bx + 1) * b)
+            for by in range(ylb // b, (yub - 1) // b + 1):
+                y0, y1 = max(ylb, by * b), min(yub, (by + 1) * b)
+                runs = self._get_runs(bx, by, k)[x0-bx*b:x1-bx*b, y0-by*b:y1-by*b]
+                np.maximum(runs[:, :, zlb], runs[:, :, zub - (1 << k)],
+                           out=image[x0-xlb:x1-xlb, y0-ylb:y1-ylb])
+        return image
+
+
+class VolumeNDImage(NDImage):
+    '''
+    NDImage backed by a lazily-loaded volume (e.g., `ImarisVolume`)
+
+    Only the z-planes needed for the current substack are read. If a pyramid
+    of downsampled volumes is provided (`levels`), the image can be rendered
+    from any level and cropped to a region of interest so that only the data
+    needed to fill the screen is read.
+    '''
+    image = Value()
+
+    #: Volumes, from finest (i.e., `image`) to coarsest resolution.
+    levels = List()
+
+    #: Cache of maximum projections through the full stack for each level.
+    z_projections = Dict()
+
+    #: Cache of maximum projections along the x or y axis keyed by (axis,
+    #: level).
+    side_projections = Dict()
+
+    #: Number of z-planes to read at a time when computing the projection.
+    block_size = Int(16)
+
+    #: Cache used to project substacks for each level (see `SubstackCache`).
+    substack_caches = Dict()
+
+    #: Cache of the per-channel values used to normalize the image keyed by
+    #: norm_percentile.
+    image_norm = Dict()
+
+    def __init__(self, info, image, levels=None, **kwargs):
+        super().__init__(info, image, **kwargs)
+        self.levels = levels if levels else [image]
+
+    @property
+    def n_levels(self):
+        return len(self.levels)
+
+    def get_level_voxel_size(self, level):
+        # Levels are assumed to span the same physical extent as the
+        # full-resolution image.
+        scale = np.array(self.image.shape[:3]) / self.levels[level].shape[:3]
+        return np.array(self.info['voxel_size'][:3]) * scale
+
+    def select_level(self, resolution):
+        '''
+        Return coarsest level with a voxel size no larger than `resolution`
+
+        `resolution` is the size (in the same units as `voxel_size`) of a
+        single screen pixel.
+        '''
+        for level in range(self.n_levels - 1, 0, -1):
+            if self.get_level_voxel_size(level)[0] <= resolution:
+                return level
+        return 0
+
+    @timed('model.z_projection')
+    def get_z_projection(self, level=0):
+        if level not in self.z_projections:
+            volume = self.levels[level]
+            projection = None
+            for lb in range(0, volume.shape[2], self.block_size):
+                block = volume[:, :, lb:lb+self.block_size].max(axis=2)
+                if projection is None:
+                    projection = block
+                else:
+                    np.maximum(projection, block, out=projection)
+            self.z_projections[level] = projection
+        return self.z_projections[level]
+
+    @timed('model.side_projection')
+    def get_side_projection(self, axis, level=0):
+        '''
+        Maximum projection along the x or y axis
+
+        The volume is read `block_size` z-planes at a time (as for
+        `get_z_projection`) rather than all at once.
+        '''
+        key = (axis, level)
+        if key not in self.side_projections:
+            volume = self.levels[level]
+            ai = 'xy'.index(axis)
+            blocks = [volume[:, :, lb:lb+self.block_size].max(axis=ai)
+                      for lb in range(0, volume.shape[2], self.block_size)]
+            self.side_projections[key] = np.concatenate(blocks, axis=1)
+        return self.side_projections[key]
+
+    def get_substack_cache(self, level):
+        if level not in self.substack_caches:
+            self.substack_caches[level] = SubstackCache(self.levels[level])
+        return self.substack_caches[level]
+
+    def _get_region(self, level, bounds):
+        # Convert bounds (xlb, xub, ylb, yub) to XY voxel slices in the
+        # requested level.
+        shape = self.levels[level].shape[:2]
+        if bounds is None:
+            return tuple(slice(0, n) for n in shape)
+        voxel_size = self.get_level_voxel_size(level)
+        region = []
+        for d, n in enumerate(shape):
+            lb, ub = bounds[d*2:d*2+2]
+            lb = int(np.floor((lb - self.extent[d*2]) / voxel_size[d]))
+            ub = int(np.ceil((ub - self.extent[d*2]) / voxel_size[d]))
+            lb = int(np.clip(lb, 0, n - 1))
+            region.append(slice(lb, int(np.clip(ub, lb + 1, n))))
+        return tuple(region)
+
+    def get_region_extent(self, level=0, bounds=None):
+        '''
+        Return extent of the image returned by `get_image` for the level and bounds
+        '''
+        voxel_size = self.get_level_voxel_size(level)
+        extent = []
+        for d, s in enumerate(self._get_region(level, bounds)):
+            extent.append(self.extent[d*2] + s.start * voxel_size[d])
+            extent.append(self.extent[d*2] + s.stop * voxel_size[d])
+        return tuple(extent)
+
+    def _get_level_z_slice(self, level, z_slice):
+        # z_slice is in full-resolution planes.
+        nz0 = self.image.shape[2]
+        nz = self.levels[level].shape[2]
+        lb, ub, _ = z_slice.indices(nz0)
+        lb = int(np.floor(lb * nz / nz0))
+        ub = max(int(np.ceil(ub * nz / nz0)), lb + 1)
+        return slice(lb, ub)
+
+    @timed('model.overview_image')
+    def get_image(self, channels=None, z_slice=None, axis='z',
+                  norm_percentile=99, level=0, bounds=None):
+        channel_config = self.get_channel_config(channels)
+        if axis != 'z':
+            # Normalized using the projection through the full volume (as
+            # for `ndimage_enaml.util.get_image`). Bounds are ignored.
+            projection = self.get_side_projection(axis, level)
+            img_max = np.percentile(projection, norm_percentile, axis=(0, 1))
+            if z_slice is None:
+                image = projection
+            else:
+                if not isinstance(z_slice, slice):
+                    z_slice = slice(int(z_slice), int(z_slice) + 1)
+                image = projection[:, self._get_level_z_slice(level, z_slice)]
+            return color_channels(normalize_channels(image, img_max), channel_config)
+
+        # Normalize using the projection through the full stack so that the
+        # normalization remains constant when stepping through the substacks.
+        # The coarsest level is used so that the normalization does not change
+        # when switching between levels.
+        if norm_percentile not in self.image_norm:
+            projection = self.get_z_projection(self.n_levels - 1)
+            self.image_norm[norm_percentile] = \
+                np.percentile(projection, norm_percentile, axis=(0, 1))
+        img_max = self.image_norm[norm_percentile]
+
+        xs, ys = self._get_region(level, bounds)
+        if z_slice is None:
+            image = self.get_z_projection(level)[xs, ys]
+        else:
+            zs = self._get_level_z_slice(level, z_slice)
+            image = self.get_substack_cache(level).project(xs, ys, zs)
+        return color_channels(normalize_channels(image, img_max), channel_config)
 
 
 class Points(Atom):
 
     overview = Typed(NDImage)
+
+    #: Tiles for the marker being analyzed. Only the labels for this marker
+    #: are saved.
     points = Typed(TiledNDImage)
 
-    def __init__(self, image_info, image, point_info, point_images):
-        self.overview = NDImage(image_info, image, channel_defaults=CHANNEL_CONFIG)
-        self.points = TiledNDImage(image_info, point_info, point_images)
+    #: Marker being analyzed.
+    marker = Str()
+
+    #: All markers that tiles can be shown for.
+    markers = List()
+
+    #: Callable that returns the tile information, tiles and codec for a
+    #: marker (e.g., `BaseReader.get_tiles`).
+    tile_loader = Callable()
+
+    #: Tiles for the other markers, extracted when first requested. The least
+    #: recently used are discarded once there are more than `max_tile_sets`.
+    tile_sets = Dict()
+    max_tile_sets = Int(2)
+
+    #: Number of worker processes used for large tile sets (see
+    #: `TiledNDImage.tile_workers`).
+    tile_workers = Int(0)
+
+    def __init__(self, image_info, image, point_info, point_images, image_levels=None,
+                 marker='', markers=None, tile_loader=None, tile_codec=None, tile_workers=0):
+        self.overview = VolumeNDImage(image_info, image, levels=image_levels,
+                                      channel_defaults=CHANNEL_CONFIG)
+        self.points = TiledNDImage(image_info, point_info, point_images, tile_codec,
+                                   tile_workers=tile_workers)
+        self.tile_workers = tile_workers
+        self.marker = marker
+        self.markers = list(markers) if markers is not None else [marker]
+        if tile_loader is not None:
+            self.tile_loader = tile_loader
+
+    @timed('model.tile_set')
+    def get_tile_set(self, marker):
+        '''
+        Return tiles for the marker
+
+        Tiles for markers other than `marker` cannot be labeled.
+        '''
+        if marker == self.marker:
+            return self.points
+        if marker not in self.markers:
+            raise ValueError(f'No spots for marker {marker}')
+        if self.tile_loader is None:
+            raise ValueError(f'Tiles can only be loaded for {self.marker}')
+        factory = lambda: TiledNDImage(self.overview.info, *self.tile_loader(marker),
+                                       editable=False, tile_workers=self.tile_workers)
+        return _cache_get(self.tile_sets, marker, factory, self.max_tile_sets)
 
     def get_state(self):
         return {
@@ -1,57 +1,283 @@
 from copy import deepcopy
+from datetime import datetime, timezone
+import getpass
+import socket
 
-from atom.api import Atom, Bool, Dict, Event, Float, Instance, Int, Str, Typed, Value
+from atom.api import Atom, Bool, Dict, Event, Float, Instance, Int, List, Str, Tuple, Typed, Value
 from enaml.application import deferred_call
 from matplotlib.axes import Axes
+from matplotlib.collections import PolyCollection
 from matplotlib.figure import Figure
 from matplotlib.image import AxesImage
 from matplotlib.patches import Circle
 import numpy as np
 
 from ndimage_enaml.model import NDImageCollection
-from ndimage_enaml.util import project_image
 from ndimage_enaml.presenter import FigurePresenter, NDImageCollectionPresenter, NDImagePlot, StatePersistenceMixin
 
+from .config import LABEL_CONFIG
+from .instrument import span, timed
 from .model import Points, TiledNDImage
 from .reader import BaseReader
+from .redraw import RedrawScheduler, scheduler
+from .state import merge_journal
 
 
-class OverviewPresenter(NDImageCollectionPresenter):
+class ScheduledRedrawMixin(Atom):
+    '''
+    Draws the figure in the frames of a shared `RedrawScheduler`
+
+    Artists added via `add_animated_artist` are drawn on top of a cached copy
+    of the rest of the figure, so changes to them only require a blit.
+    '''
+    scheduler = Typed(RedrawScheduler)
+
+    #: Artists that are blitted on top of the background.
+    animated_artists = List()
+
+    #: Copy of the figure (without the animated artists) from the last full
+    #: draw. None if the canvas does not support blitting.
+    background = Value()
+
+    def _default_scheduler(self):
+        return scheduler
+
+    def add_animated_artist(self, artist):
+        if not self.animated_artists:
+            self.figure.canvas.mpl_connect('draw_event', self._on_draw)
+        artist.set_animated(True)
+        self.animated_artists.append(artist)
+
+    def request_redraw(self, event=None):
+        self.needs_redraw = True
+        self.scheduler.request(self)
+
+    def request_blit(self):
+        self.scheduler.request(self, full=False)
+
+    def _on_draw(self, event):
+        canvas = self.figure.canvas
+        if getattr(canvas, 'supports_blit', False):
+            self.background = canvas.copy_from_bbox(self.figure.bbox)
+        else:
+            self.background = None
+        self._draw_animated()
+
+    def _draw_animated(self):
+        for artist in self.animated_artists:
+            self.figure.draw_artist(artist)
+
+    def blit(self):
+        if self.background is None:
+            self.redraw()
+            return
+        canvas = self.figure.canvas
+        canvas.restore_region(self.background)
+        self._draw_animated()
+        canvas.blit(self.figure.bbox)
+
+
+class OverviewPlot(NDImagePlot):
+    '''
+    Renders the overview from the coarsest resolution level that still fills
+    the visible region of the axes.
+    '''
+    #: Resolution level currently rendered
+    level = Int(0)
+
+    #: Region (xlb, xub, ylb, yub) currently rendered. If None, the full image
+    #: is rendered.
+    bounds = Value()
+
+    #: Fraction of the visible region to render on each side so that small
+    #: pans do not require reading from the volume again.
+    margin = Float(0.5)
+
+    def request_redraw(self, event=None):
+        # The image is rendered by the presenter when the next frame is drawn.
+        self.needs_redraw = True
+        self.updated = True
+
+    def _observe_ndimage(self, event):
+        super()._observe_ndimage(event)
+        # Start with the coarsest level. The appropriate level will be
+        # selected once the axes are displayed.
+        self.level = event['value'].n_levels - 1
+        self.bounds = None
+
+    def update_view(self):
+        '''
+        Select level and bounds for the current axes limits
+
+        Returns True if the image needs to be rendered again.
+        '''
+        width, height = self.axes.get_window_extent().size
+        if width < 1 or height < 1:
+            return False
+        xlb, xub = sorted(self.axes.get_xlim())
+        ylb, yub = sorted(self.axes.get_ylim())
+        resolution = min((xub - xlb) / width, (yub - ylb) / height)
+        level = self.ndimage.select_level(resolution)
+        if level == self.level and self.bounds is not None:
+            # Keep the rendered region unless the view has moved outside of it
+            # or we have zoomed in enough that most of it is offscreen.
+            bxlb, bxub, bylb, byub = self.bounds
+            contains = (bxlb <= xlb) and (xub <= bxub) and (bylb <= ylb) and (yub <= byub)
+            max_width = 2 * (1 + 2 * self.margin) * (xub - xlb)
+            if contains and (bxub - bxlb) <= max_width:
+                return False
+        dx = (xub - xlb) * self.margin
+        dy = (yub - ylb) * self.margin
+        self.level = level
+        self.bounds = (xlb - dx, xub + dx, ylb - dy, yub + dy)
+        return True
+
+    def get_image(self):
+        z_slice = None if self.display_mode == 'projection' else self.z_slice
+        channels = [c for c in self.channel_config.values() if c.visible]
+        image = self.ndimage.get_image(channels=channels, z_slice=z_slice,
+                                       level=self.level, bounds=self.bounds)
+        return image.swapaxes(0, 1)
+
+    @timed('render.overview')
+    def redraw(self, event=None):
+        self.artist.set_data(self.get_image())
+        self.artist.set_extent(self.ndimage.get_region_extent(self.level, self.bounds))
+        xlb, xub, ylb, yub = self.ndimage.get_image_extent()[:4]
+        self.rectangle.set_bounds(xlb, ylb, xub-xlb, yub-ylb)
+        t = self.ndimage.get_image_transform()
+        if self.auto_rotate:
+            self.rotation_transform.set_matrix(t.get_matrix())
+        self.updated = True
+
+
+class OverviewPresenter(ScheduledRedrawMixin, NDImageCollectionPresenter):
 
     highlight_artist = Value()
 
+    #: Most recent selection that has not been drawn yet.
+    pending_selection = Value()
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.highlight_artist = Circle((0, 0), radius=0, linewidth=1, facecolor='none', edgecolor='white')
         self.axes.add_patch(self.highlight_artist)
+        self.add_animated_artist(self.highlight_artist)
         self.current_artist.display_mode = 'slice'
         # This sets the thickness to 10
         self.current_artist.z_slice_ub = 10
 
+    def _observe_obj(self, event):
+        self.ndimage_artists = {
+            t.source: OverviewPlot(self.axes, t, auto_rotate=self.rotate_ndimage) for t in self.obj
+        }
+        for artist in self.ndimage_artists.values():
+            artist.observe('updated', self.request_redraw)
+        self.current_artist_index = 0
+        self.axes.axis('equal')
+        self.axes.axis(self.obj.get_image_extent())
+
     def highlight_selected(self, event):
         value = event['value']
         if not value:
             return
-        span = 6
+        # Only the most recent selection is shown when the next frame is
+        # drawn.
+        self.pending_selection = value
+        self.request_redraw()
+
+    def _show_selection(self, value):
+        half_width = 6
         extent = (
-                value['x'] - span,
-                value['x'] + span,
-                value['y'] - span,
-                value['y'] + span,
+                value['x'] - half_width,
+                value['x'] + half_width,
+                value['y'] - half_width,
+                value['y'] + half_width,
                 )
         self.axes.axis(extent)
         self.highlight_artist.set_center((value['x'], value['y']))
         self.highlight_artist.set_radius(0.5)
         self.current_artist.center_z_substack(int(value['zi']))
-        self.request_redraw()
 
+    @timed('redraw.overview')
+    def redraw(self):
+        if self.pending_selection is not None:
+            self._show_selection(self.pending_selection)
+            self.pending_selection = None
+        artist = self.current_artist
+        if artist is not None and (artist.update_view() or artist.needs_redraw):
+            # Don't let the `updated` event queue up a second redraw.
+            with artist.suppress_notifications():
+                artist.redraw()
+            artist.needs_redraw = False
+        with span('draw.overview'):
+            super().redraw()
 
-class TiledNDImagePlot(NDImagePlot):
 
+class TiledNDImagePlot(NDImagePlot):
+    '''
+    Renders only the rows of the mosaic that are visible in the axes
+    '''
     sort_channel = Str('GluR2')
     sort_value = Str('max')
     sort_radius = Float(0.5)
 
+    #: First and last row of tiles currently rendered.
+    rows = Tuple()
+
+    #: Number of rows to render above and below the visible rows (as a
+    #: fraction of the number of visible rows) so that small scrolls do not
+    #: require rendering tiles again.
+    margin = Float(1)
+
+    def update_view(self):
+        '''
+        Select rows to render for the current axes limits
+
+        Returns True if the rendered rows changed.
+        '''
+        r0, r1 = self.ndimage.get_row_range(*sorted(self.axes.get_ylim()))
+        n = max(r1 - r0, 1)
+        if self.rows:
+            contains = (self.rows[0] <= r0) and (r1 <= self.rows[1])
+            max_rows = 2 * (1 + 2 * self.margin) * n
+            if contains and (self.rows[1] - self.rows[0]) <= max_rows:
+                return False
+        m = int(np.ceil(n * self.margin))
+        self.rows = (max(r0 - m, 0), min(r1 + m, self.ndimage.n_rows))
+        return True
+
+    def request_redraw(self, event=None):
+        # The mosaic is rendered by the presenter when the next frame is drawn.
+        self.needs_redraw = True
+        self.updated = True
+
+    def get_image(self):
+        z_slice = None if self.display_mode == 'projection' else self.z_slice
+        channels = [c for c in self.channel_config.values() if c.visible]
+        image = self.ndimage.get_image(channels=channels, z_slice=z_slice, rows=self.rows)
+        return image.swapaxes(0, 1)
+
+    @timed('render.points')
+    def redraw(self, event=None):
+        # The presenter selects the rows (see `update_view`) before redrawing.
+        if not self.rows:
+            self.update_view()
+        self.artist.set_data(self.get_image())
+        self.artist.set_extent(self.ndimage.get_rows_extent(*self.rows))
+        self.updated = True
+
+    def _observe_ndimage(self, event):
+        super()._observe_ndimage(event)
+        # Sort new tiles (e.g., when switching markers) the same way.
+        ndimage = event['value']
+        if self.sort_channel in ndimage.channel_names:
+            ndimage.sort_channel = self.sort_channel
+        ndimage.sort_value = self.sort_value
+        ndimage.sort_radius = self.sort_radius
+        self.rows = ()
+        self.request_redraw()
+
     def _observe_sort_radius(self, event):
         self.ndimage.sort_radius = self.sort_radius
         self.request_redraw()
@@ -65,7 +291,7 @@ class TiledNDImagePlot(NDImagePlot):
         self.request_redraw()
 
 
-class PointsPresenter(NDImageCollectionPresenter):
+class PointsPresenter(ScheduledRedrawMixin, NDImageCollectionPresenter):
 
     obj = Instance(TiledNDImage)
     artist = Value()
@@ -73,6 +299,11 @@ class PointsPresenter(NDImageCollectionPresenter):
     selected_coords = Value()
     parent = Value()
 
+    #: Outlines of the labeled tiles keyed by label. These are blitted on top
+    #: of the mosaic so that labeling or selecting a tile does not require
+    #: rendering the mosaic again.
+    label_artists = Dict()
+
     def _default_artist(self):
         artist = TiledNDImagePlot(self.axes)
         artist.observe('updated', self.request_redraw)
@@ -83,12 +314,77 @@ class PointsPresenter(NDImageCollectionPresenter):
         return self.artist
 
     def _observe_obj(self, event):
+        if event.get('oldvalue') is not None:
+            event['oldvalue'].unobserve('labels_updated', self._labels_updated)
+        self.obj.observe('labels_updated', self._labels_updated)
         self.artist.ndimage = self.obj
+        # Start with the first rows of the mosaic. The axes are kept at an
+        # equal aspect ratio, so the visible rows will expand to fill the
+        # canvas.
+        xlb, xub, ylb, yub = self.obj.get_image_extent()
+        self.axes.axis((xlb, xub, ylb, min(yub, ylb + (xub - xlb))))
+
+    def _labels_updated(self, event=None):
+        self.update_label_artists()
+        self.request_blit()
+
+    def _observe_selected(self, event):
+        self.update_label_artists()
+        self.request_blit()
+
+    def update_label_artists(self):
+        '''
+        Update outlines of the labeled tiles (including the selected tile)
+        '''
+        extents = self.obj.get_label_extents()
+        for label, extent in extents.items():
+            config = LABEL_CONFIG.get(label, {})
+            if label not in self.label_artists:
+                artist = PolyCollection([], facecolors='none', linewidths=1,
+                                        edgecolors=config.get('display_color', 'white'),
+                                        linestyles=config.get('linestyle', '-'),
+                                        zorder=20 if label == 'selected' else 10)
+                self.axes.add_collection(artist, autolim=False)
+                self.add_animated_artist(artist)
+                self.label_artists[label] = artist
+            # Outline the pixels surrounding the tile (`border_expand` pixels
+            # from the edge of the tile).
+            expand = config.get('border_expand', 1) - 0.5
+            xlb, xub, ylb, yub = extent.T
+            xlb, ylb = xlb - expand, ylb - expand
+            xub, yub = xub + expand, yub + expand
+            verts = np.stack([
+                np.column_stack((xlb, ylb)),
+                np.column_stack((xub, ylb)),
+                np.column_stack((xub, yub)),
+                np.column_stack((xlb, yub)),
+            ], axis=1)
+            self.label_artists[label].set_verts(verts)
+        for label, artist in self.label_artists.items():
+            if label not in extents:
+                artist.set_verts([])
+
+    def scroll_to_tile(self, i):
+        '''
+        Pan the axes vertically so that the tile is visible
+
+        Returns True if the axes were panned.
+        '''
+        _, _, tlb, tub = self.obj.get_tile_extent(i)
+        ylb, yub = self.axes.get_ylim()
+        if tlb < ylb:
+            self.axes.set_ylim(tlb - self.obj.padding, yub - ylb + tlb - self.obj.padding)
+        elif tub > yub:
+            self.axes.set_ylim(ylb + tub - yub + self.obj.padding, tub + self.obj.padding)
+        else:
+            return False
+        return True
 
     def right_button_press(self, event):
         x, y = event.xdata, event.ydata
-        self.selected = self.obj.select_tile_by_coords(x, y)
-        self.request_redraw()
+        selected = self.obj.select_tile_by_coords(x, y)
+        if selected is not None:
+            self.selected = selected
 
     def key_press(self, event):
         if event.key.lower() == 'd':
@@ -99,6 +395,8 @@ class PointsPresenter(NDImageCollectionPresenter):
             self.apply_label('orphan')
         if event.key.lower() == 'c':
             self.clear_label()
+        if event.key.lower() == 'enter':
+            self.accept_suggestion()
         if event.key.lower() == 'right':
             self.select_next_tile(1)
         if event.key.lower() == 'left':
@@ -111,39 +409,67 @@ class PointsPresenter(NDImageCollectionPresenter):
             self.parent.save_state()
 
     def apply_label(self, label):
-        self.obj.unlabel_tile(self.selected['i'])
-        self.obj.label_tile(self.selected['i'], label)
-        self.request_redraw()
+        i = self.selected['i']
+        # Don't journal (or redraw) anything if the key is pressed again.
+        if i in self.obj.labels.get(label, set()):
+            return
+        self.obj.unlabel_tile(i)
+        self.obj.label_tile(i, label)
 
     def clear_label(self):
         self.obj.unlabel_tile(self.selected['i'])
-        self.request_redraw()
+
+    def accept_suggestion(self):
+        self.obj.accept_suggestion(self.selected['i'])
 
     def select_next_tile(self, step):
         with self.suppress_notifications():
             if step is None:
-                i = self.obj.ordering[0]
+                i = int(self.obj.tile_at_rank(0))
                 step = 0
             else:
-                i = self.selected.get('i', self.obj.ordering[0])
+                i = self.selected.get('i', int(self.obj.tile_at_rank(0)))
         self.selected = self.obj.select_next_tile(i, step)
-        self.request_redraw()
+        # Only the overlay needs to be updated unless the view moved.
+        if self.scroll_to_tile(self.selected['i']):
+            self.request_redraw()
 
+    @timed('redraw.points')
     def redraw(self):
-        self.artist.redraw()
-        super().redraw()
+        artist = self.artist
+        # Only render the tiles again if the view moved past the rendered
+        # rows or the display settings changed.
+        if artist.update_view() or artist.needs_redraw:
+            with artist.suppress_notifications():
+                artist.redraw()
+            artist.needs_redraw = False
+        # The position of the labeled tiles changes when the tiles are sorted.
+        self.update_label_artists()
+        with span('draw.points'):
+            super().redraw()
 
     def check_for_changes(self):
         pass
 
 
-class PointProjectionPresenter(FigurePresenter):
+class PointProjectionPresenter(ScheduledRedrawMixin, FigurePresenter):
 
     obj = Value()
     artist = Value()
     vertical_crosshairs = Value()
     horizontal_crosshairs = Value()
 
+    #: Most recent selection that has not been drawn yet.
+    pending_selection = Value()
+
+    #: Number of tiles on either side of the selection (in the order shown in
+    #: the mosaic) to project ahead of time so that browsing with the arrow
+    #: keys does not wait on rendering. Zero disables prefetching.
+    n_prefetch = Int(12)
+
+    #: Padding between the projections.
+    padding = Int(1)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.axes.set_axis_off()
@@ -152,34 +478,104 @@ class PointProjectionPresenter(FigurePresenter):
         self.axes.axis('equal')
         self.vertical_crosshairs = [self.axes.axvline(0, color='w', ls=':', alpha=0.5) for _ in range(6)]
         self.horizontal_crosshairs = [self.axes.axhline(0, color='w', ls=':', alpha=0.5) for _ in range(2)]
+        # The projection and crosshairs are the only things that change, so
+        # they are blitted on top of the (empty) axes.
+        for artist in [self.artist] + self.vertical_crosshairs + self.horizontal_crosshairs:
+            self.add_animated_artist(artist)
 
     def highlight_selected(self, event):
-        padding = 1
-        tile = self.obj.tiles[event['value']['i']]
-        img = project_image(tile, self.obj.get_channel_config(), padding)
+        # Only the most recent selection is shown when the next frame is
+        # drawn.
+        self.pending_selection = event['value']
+        self.request_blit()
+
+    def _show_selection(self, value):
+        '''
+        Update artists for the selection
+
+        Returns True if the extent of the image changed (and the background
+        needs to be redrawn since the axes limits will change).
+        '''
+        padding = self.padding
+        i = value['i']
+        with span('render.point_projection'):
+            img = self.obj.get_point_projections([i], self.obj.get_channel_config(), padding)[0]
         self.artist.set_data(img)
+        if self.n_prefetch > 0:
+            # Runs once the current frame has been drawn.
+            deferred_call(self.prefetch, i)
         y, x = img.shape[:2]
-        self.artist.set_extent((0, x, 0, y))
+        extent = (0, x, 0, y)
+        if tuple(self.artist.get_extent()) == extent:
+            return False
+        # This autoscales the axes.
+        self.artist.set_extent(extent)
 
-        xs, ys, _, _ = tile.shape
+        xs, ys = self.obj.tiles.shape[1:3]
         for i, a in enumerate(self.vertical_crosshairs):
             o = i * (xs + padding) + padding + xs * 0.5
             a.set_data(([o, o], [0, 1]))
         for i, a in enumerate(self.horizontal_crosshairs):
             o = i * (xs + padding) + padding + ys * 0.5
             a.set_data(([0, 1], [o, o]))
-
-        self.figure.canvas.draw()
+        return True
+
+    @timed('render.point_projection_prefetch')
+    def prefetch(self, i):
+        '''
+        Project the tiles surrounding tile `i` in the mosaic
+        '''
+        neighbors = self.obj.get_neighbors(i, self.n_prefetch)
+        self.obj.get_point_projections(neighbors, self.obj.get_channel_config(), self.padding)
+
+    @timed('redraw.point_projection')
+    def blit(self):
+        value, self.pending_selection = self.pending_selection, None
+        if value is not None and self._show_selection(value):
+            self.redraw()
+        else:
+            super().blit()
+
+    @timed('redraw.point_projection')
+    def redraw(self):
+        value, self.pending_selection = self.pending_selection, None
+        if value is not None:
+            self._show_selection(value)
+        with span('draw.point_projection'):
+            super().redraw()
 
 
 class SynaptogramPresenter(StatePersistenceMixin):
-
+    '''
+    Saving appends the label edits made since the last save to the journal
+    (see `synaptogram.state`). The journal is compacted into a new snapshot
+    once it has `max_journal_size` entries.
+    '''
     obj = Typed(object)
     reader = Instance(BaseReader)
     overview = Instance(OverviewPresenter)
     points = Instance(PointsPresenter)
     point_projection = Instance(PointProjectionPresenter)
 
+    #: Value of `TiledNDImage.edit_count` when the analysis was last saved or
+    #: loaded.
+    saved_edit_count = Int(0)
+
+    #: True if there is a snapshot to append to. Otherwise, the next save
+    #: writes a snapshot.
+    has_snapshot = Bool(False)
+
+    #: Number of entries in the journal.
+    journal_size = Int(0)
+    max_journal_size = Int(100)
+
+    #: Generation of the snapshot (see `synaptogram.state.write_state`).
+    #: Included in each journal entry.
+    generation = Str()
+
+    #: Marker whose tiles are shown (see `Points.get_tile_set`).
+    marker = Str()
+
     def _observe_obj(self, event):
         if self.obj is not None:
             self.overview = OverviewPresenter(obj=NDImageCollection([self.obj.overview]))
@@ -188,15 +584,63 @@ class SynaptogramPresenter(StatePersistenceMixin):
             self.points.observe('selected', self.overview.highlight_selected)
             self.points.observe('selected', self.point_projection.highlight_selected)
             self.obj.points.observe('labels_updated', self.check_for_changes)
+            self.saved_edit_count = self.obj.points.edit_count
+            self.marker = self.obj.marker
+
+    @timed('load.marker')
+    def _observe_marker(self, event):
+        tiles = self.obj.get_tile_set(self.marker)
+        if tiles is self.points.obj:
+            return
+        self.point_projection.obj = tiles
+        self.points.obj = tiles
+        self.points.select_next_tile(None)
 
     def update_state(self):
         super().update_state()
         self.points.request_redraw()
 
+    @timed('state.save')
+    def save_state(self, include_meta=True):
+        history = {
+            'user': getpass.getuser(),
+            'host': socket.gethostname(),
+            'modified': datetime.now(timezone.utc).isoformat(),
+        }
+        self.saved_meta.setdefault('history', []).append(history)
+        if self.has_snapshot and self.journal_size < self.max_journal_size:
+            self.reader.append_state(self.obj, {
+                'generation': self.generation,
+                'edits': self.obj.points.pending_edits,
+                'overview': self.obj.overview.get_state(),
+                'history': history,
+            })
+            self.journal_size += 1
+        else:
+            state = self.get_full_state()
+            state['meta'] = self.saved_meta.copy()
+            self.reader.save_state(self.obj, state)
+            self.generation = state['meta'].get('generation', '')
+            self.has_snapshot = True
+            self.journal_size = 0
+        self.obj.points.clear_edits()
+        self.saved_edit_count = self.obj.points.edit_count
+        self.update_state()
+
+    @timed('state.load')
+    def load_state(self):
+        try:
+            state = self.reader.load_state(self.obj)
+        except IOError:
+            return
+        self.journal_size = len(state.get('journal', []))
+        state = merge_journal(state)
+        self.obj.set_state(state['data'])
+        self.saved_meta = state.get('meta', {})
+        self.generation = self.saved_meta.get('generation', '')
+        self.has_snapshot = True
+        self.saved_edit_count = self.obj.points.edit_count
+        self.update_state()
+
     def check_for_changes(self, event=None):
-        saved = self.saved_state['data']['points']['labels']
-        unsaved = self.get_full_state()['data']['points']['labels']
-        saved.pop('selected', None)
-        unsaved.pop('selected', None)
-        get_labels = lambda s: {k: list(int(i) for i in v) for k, v in s.items() if len(v) > 0}
-        self.unsaved_changes = get_labels(saved) != get_labels(unsaved)
+        self.unsaved_changes = self.obj.points.edit_count != self.saved_edit_count
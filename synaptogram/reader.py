@@ -1,14 +1,26 @@
-from functools import cached_property
-import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property, lru_cache, partial
+import itertools
+import logging
+import os
 from pathlib import Path
 import re
+import time
+import zlib
 
 import numpy as np
 import pandas as pd
 
 import h5py
 
+from .cache import TileCache
+from .instrument import span, timed
 from .model import Points
+from .spatial import get_neighbor_info
+from .state import append_journal, read_state, write_state
+from .tilestore import TileCodec
+
+log = logging.getLogger(__name__)
 
 
 def extract_str(attrs, key):
@@ -19,57 +31,541 @@ def extract_value(attrs, key):
     return float(''.join(attrs[key].astype('U')))
 
 
+#: Columns of `PointTable.values`
+POINT_COLUMNS = ['x', 'y', 'z', 'radius_x', 'radius_y', 'radius_z']
+
+
 def extract_points(node):
-    cols = []
-    if 'CoordsXYZR' in node:
-        coords = node['CoordsXYZR'][:]
-        cols.extend(['x', 'y', 'z', 'radius_x'])
-    else:
-        coords = []
+    '''
+    Return array of the spots in the node (see `POINT_COLUMNS`)
+    '''
+    if 'CoordsXYZR' not in node:
+        return np.empty((0, len(POINT_COLUMNS)))
+    coords = node['CoordsXYZR']
+    points = np.full((len(coords), len(POINT_COLUMNS)), np.nan)
+    coords.read_direct(points, np.s_[:, :4], np.s_[:, :4])
     if 'RadiusYZ' in node:
-        radius = node['RadiusYZ'][:]
-        cols.extend(['radius_y', 'radius_z'])
-        coords =  np.c_[coords, radius]
-    return pd.DataFrame(coords, columns=cols)
+        node['RadiusYZ'].read_direct(points, np.s_[:, :2], np.s_[:, 4:])
+    return points
+
+
+class PointTable:
+    '''
+    Columnar table of the spots in a scene
+
+    Each column is a NumPy array with one row per spot. Markers are stored as
+    integer codes into `markers` and the rows are grouped by marker so that
+    the spots for a marker are a slice of the table (see `get_marker`). Use
+    `to_frame` to get a DataFrame.
+    '''
+
+    def __init__(self, markers, codes, node_index, index, values, voxels):
+        #: Name of each marker
+        self.markers = list(markers)
+        #: Marker of each spot (index into `markers`)
+        self.codes = codes
+        #: Index of the `Scene/Content` node and index of the spot in the node
+        self.node_index = node_index
+        self.index = index
+        #: Position and radius of each spot (see `POINT_COLUMNS`)
+        self.values = values
+        #: Position of each spot in voxels (x, y, z)
+        self.voxels = voxels
+        self._offsets = np.searchsorted(codes, np.arange(len(self.markers) + 1))
+
+    @classmethod
+    def from_nodes(cls, nodes, lower, voxel_size):
+        '''
+        Create table from list of (node index, marker, array of points)
+        '''
+        markers = list(dict.fromkeys(marker for _, marker, _ in nodes))
+        n = [len(p) for _, _, p in nodes]
+        codes = np.repeat([markers.index(m) for _, m, _ in nodes], n).astype('int16')
+        node_index = np.repeat([i for i, _, _ in nodes], n)
+        index = np.concatenate([np.arange(k) for k in n]) if nodes else np.empty(0, int)
+        values = np.concatenate([p for _, _, p in nodes]) if nodes else \
+            np.empty((0, len(POINT_COLUMNS)))
+        order = np.argsort(codes, kind='stable')
+        if np.any(order != np.arange(len(order))):
+            codes, node_index, index, values = \
+                codes[order], node_index[order], index[order], values[order]
+        voxels = np.round((values[:, :3] - lower) / voxel_size).astype('int32')
+        return cls(markers, codes, node_index, index, values, voxels)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def rename_markers(self, mapping):
+        '''
+        Return table with the markers renamed using the mapping
+
+        Markers renamed to the same name (or to the name of an existing
+        marker) are merged.
+        '''
+        renamed = [mapping.get(m, m) for m in self.markers]
+        markers = list(dict.fromkeys(renamed))
+        if len(markers) == len(renamed):
+            return PointTable(markers, self.codes, self.node_index, self.index,
+                              self.values, self.voxels)
+        lookup = np.array([markers.index(m) for m in renamed], dtype=self.codes.dtype)
+        codes = lookup[self.codes]
+        order = np.argsort(codes, kind='stable')
+        return PointTable(markers, codes[order], self.node_index[order],
+                          self.index[order], self.values[order], self.voxels[order])
+
+    def get_marker(self, marker):
+        '''
+        Return the spots for the marker (as a view of this table)
+        '''
+        try:
+            code = self.markers.index(marker)
+        except ValueError:
+            raise KeyError(marker)
+        s = slice(self._offsets[code], self._offsets[code + 1])
+        return PointTable(self.markers, self.codes[s], self.node_index[s],
+                          self.index[s], self.values[s], self.voxels[s])
+
+    def to_frame(self, marker=None):
+        '''
+        Return table as a DataFrame indexed by node index, marker and spot
+
+        If marker is provided, only the spots for that marker are returned and
+        the marker is dropped from the index.
+        '''
+        if marker is not None:
+            return self.get_marker(marker).to_frame().droplevel('marker')
+        index = pd.MultiIndex.from_arrays([
+            self.node_index,
+            pd.Categorical.from_codes(self.codes, self.markers),
+            self.index,
+        ], names=['node_index', 'marker', 'i'])
+        df = pd.DataFrame(self.values, columns=POINT_COLUMNS, index=index)
+        for d, dim in enumerate('xyz'):
+            df[f'{dim}i'] = self.voxels[:, d]
+        return df
+
+
+def _index_slice(key, n):
+    # Converts an integer or slice along one axis into a slice with a positive
+    # step. Returns the slice and a flag indicating whether the axis should be
+    # dropped from the result (i.e., it was indexed with an integer).
+    if isinstance(key, slice):
+        s = slice(*key.indices(n))
+        if s.step < 1:
+            raise IndexError('Only positive slice steps are supported')
+        return s, False
+    i = int(key)
+    if i < 0:
+        i += n
+    if not (0 <= i < n):
+        raise IndexError(f'Index {key} is out of bounds for axis with size {n}')
+    return slice(i, i + 1, 1), True
+
+
+def _block_shape(volume, size, max_bytes):
+    # Blocks are grown a chunk at a time (smallest axis first) while the region
+    # read for a block, which extends up to `size` voxels past the block,
+    # stays under `max_bytes`. Reading whole chunks means each chunk is only
+    # decoded once per block.
+    shape = np.array(volume.shape[:-1])
+    chunks = getattr(volume, 'chunks', None) or (16, 16, 16)
+    chunks = np.minimum(chunks, shape)
+    voxel_bytes = volume.shape[-1] * np.dtype(volume.dtype).itemsize
+    region_bytes = lambda b: np.prod(b + size) * voxel_bytes
+
+    block = chunks.copy()
+    while region_bytes(block) > max_bytes and block.max() > 1:
+        a = block.argmax()
+        block[a] = (block[a] + 1) // 2
+    while True:
+        for a in np.argsort(block, kind='stable'):
+            candidate = block.copy()
+            candidate[a] = min(block[a] + chunks[a], shape[a])
+            if candidate[a] > block[a] and region_bytes(candidate) <= max_bytes:
+                block = candidate
+                break
+        else:
+            return block
+
+
+def extract_tiles(volume, indices, size=10, max_block_bytes=2**24):
+    '''
+    Cut a cubic tile of `size` voxels around each point in the volume.
+
+    Parameters
+    ----------
+    volume : array-like
+        XYZC volume (e.g., `ImarisVolume` or `np.ndarray`).
+    indices : array
+        N x 3 array of XYZ voxel indices of the tile centers.
+    size : int
+        Size of each tile (in voxels).
+    max_block_bytes : int
+        Points are processed in XYZ blocks (aligned to the chunks of the
+        volume, if any). Only the region of the volume needed by a block is
+        read at once and it is kept under this size.
+
+    Returns
+    -------
+    tiles : array
+        N x size x size x size x C array. Tiles that are clipped by the
+        volume boundaries are zero-padded at the upper end of each axis.
+    '''
+    indices = np.abs(np.asarray(indices)).astype('i').reshape((-1, 3))
+    n_channels = volume.shape[-1]
+    xyz_max = np.array(volume.shape[:-1])
+    tiles = np.zeros((len(indices), size, size, size, n_channels), dtype=volume.dtype)
+    if len(indices) == 0:
+        return tiles
+
+    lower = int(np.ceil(size / 2))
+    upper = int(np.floor(size / 2))
+    lb = np.clip(indices - lower, 0, xyz_max)
+    ub = np.clip(indices + upper, 0, xyz_max)
+    # Voxels past the (clipped) upper bound of a tile are left as zero.
+    clipped = (ub - lb < size).any(axis=1)
+
+    block_shape = _block_shape(volume, size, max_block_bytes)
+    n_blocks = xyz_max // block_shape + 1
+    blocks = np.ravel_multi_index((lb // block_shape).T, n_blocks)
+    order = np.argsort(blocks, kind='stable')
+    groups = np.split(order, np.flatnonzero(np.diff(blocks[order])) + 1)
+    for i in groups:
+        # Read the region spanned by the tiles in this block (up to the edge
+        # of the volume).
+        region_lb = lb[i].min(axis=0)
+        region_ub = np.minimum(lb[i].max(axis=0) + size, xyz_max)
+        data = volume[tuple(slice(l, u) for l, u in zip(region_lb, region_ub))]
+
+        # View of every possible window in the region. Fancy indexing then
+        # copies only the windows we need.
+        inner = i[~clipped[i]]
+        if len(inner):
+            windows = np.lib.stride_tricks.sliding_window_view(data, (size,) * 3, axis=(0, 1, 2))
+            wx, wy, wz = (lb[inner] - region_lb).T
+            tiles[inner] = windows[wx, wy, wz].transpose(0, 2, 3, 4, 1)
+
+        # Tiles clipped by the edge of the volume are copied one at a time.
+        for j in i[clipped[i]]:
+            s = tuple(slice(l, u) for l, u in zip(lb[j] - region_lb, ub[j] - region_lb))
+            n = ub[j] - lb[j]
+            tiles[j, :n[0], :n[1], :n[2]] = data[s]
+    return tiles
+
+
+#: HDF5 filters that `decode_chunk` can undo.
+H5Z_FILTER_DEFLATE = 1
+H5Z_FILTER_SHUFFLE = 2
+
+
+def get_filters(dataset):
+    '''
+    Return filter codes for the dataset (in the order they are applied)
+    '''
+    plist = dataset.id.get_create_plist()
+    return [plist.get_filter(i)[0] for i in range(plist.get_nfilters())]
+
+
+def supports_direct_read(dataset):
+    '''
+    True if the chunks of the dataset can be decoded by `decode_chunk`
+    '''
+    if dataset.chunks is None:
+        return False
+    return set(get_filters(dataset)) <= {H5Z_FILTER_DEFLATE, H5Z_FILTER_SHUFFLE}
+
+
+def decode_chunk(dataset, raw, filter_mask):
+    '''
+    Undo the filters applied to a chunk read with `read_direct_chunk`
+
+    Bit i of `filter_mask` is set if filter i was skipped for the chunk.
+    '''
+    dtype = dataset.dtype
+    for i, code in reversed(list(enumerate(get_filters(dataset)))):
+        if filter_mask & (1 << i):
+            continue
+        if code == H5Z_FILTER_DEFLATE:
+            # zlib releases the GIL, so chunks are decompressed in parallel.
+            raw = zlib.decompress(raw)
+        elif code == H5Z_FILTER_SHUFFLE and dtype.itemsize > 1:
+            raw = np.frombuffer(raw, 'u1').reshape((dtype.itemsize, -1)).T.tobytes()
+    return np.frombuffer(raw, dtype).reshape(dataset.chunks)
+
+
+@lru_cache
+def _read_executor(max_workers):
+    return ThreadPoolExecutor(max_workers, thread_name_prefix='synaptogram-read')
+
+
+def read_chunk(dataset, offset, region, out):
+    '''
+    Copy the part of the chunk at `offset` that falls in `region` into `out`
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset
+        Chunked dataset (in ZYX order).
+    offset : tuple of int
+        ZYX index of the first voxel in the chunk.
+    region : tuple of slice
+        ZYX region of the dataset being read. `out` is the XYZ array for
+        this region.
+    out : array
+        XYZ output array.
+    '''
+    src, dst = [], []
+    for o, c, r in zip(offset, dataset.chunks, region):
+        lb, ub = max(o, r.start), min(o + c, r.stop)
+        src.append(slice(lb - o, ub - o))
+        dst.append(slice(lb - r.start, ub - r.start))
+    try:
+        filter_mask, raw = dataset.id.read_direct_chunk(offset)
+    except RuntimeError:
+        # Chunk has not been written.
+        out[tuple(dst[::-1])] = dataset.fillvalue
+        return
+    chunk = decode_chunk(dataset, raw, filter_mask)
+    out[tuple(dst[::-1])] = chunk[tuple(src)].transpose(2, 1, 0)
+
+
+def read_parallel(datasets, region, out, max_workers):
+    '''
+    Read region of each dataset into the last axis of `out`
+
+    The chunks overlapping the region are read and decoded in a pool of
+    threads and copied directly into the output.
+    '''
+    tasks = []
+    for ci, dataset in enumerate(datasets):
+        ranges = [range(r.start // c * c, r.stop, c) for r, c in zip(region, dataset.chunks)]
+        for offset in itertools.product(*ranges):
+            tasks.append((dataset, offset, region, out[..., ci]))
+    executor = _read_executor(max_workers)
+    for future in [executor.submit(read_chunk, *task) for task in tasks]:
+        future.result()
+
+
+class ImarisVolume:
+    '''
+    Lazy view of the channels stored in an Imaris resolution level.
+
+    Indexing follows the same XYZC convention (and channel order) as the array
+    that used to be returned by `BaseImarisReader.image`. Only the HDF5 chunks
+    touched by a slice are read from disk.
+    '''
+
+    ndim = 4
+
+    def __init__(self, datasets, n_voxels, max_workers=1):
+        #: HDF5 datasets (in ZYX order), one per channel, sorted in the order
+        #: channels should appear in the last axis.
+        self.datasets = list(datasets)
+        self.shape = tuple(int(n) for n in n_voxels) + (len(self.datasets),)
+        self.dtype = self.datasets[0].dtype
+
+        #: Number of threads used to decode chunks. Reads are done in the
+        #: calling thread if 1 or if the datasets use filters that
+        #: `decode_chunk` does not support (e.g., LZ4).
+        self.max_workers = max_workers
+        self.direct_read = all(supports_direct_read(d) for d in self.datasets)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    @property
+    def chunks(self):
+        # Chunk shape in XYZ order.
+        chunks = self.datasets[0].chunks
+        if chunks is None:
+            return self.shape[:-1]
+        return chunks[::-1]
+
+    def _normalize_key(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = key.index(Ellipsis)
+            fill = (slice(None),) * (self.ndim - len(key) + 1)
+            key = key[:i] + fill + key[i+1:]
+        if len(key) > self.ndim:
+            raise IndexError('Too many indices for volume')
+        return key + (slice(None),) * (self.ndim - len(key))
+
+    @timed('reader.read')
+    def __getitem__(self, key):
+        *xyz_key, c_key = self._normalize_key(key)
+        slices, drop = zip(*[_index_slice(k, n) for k, n in zip(xyz_key, self.shape)])
+        channels = np.arange(self.shape[-1])[c_key]
+        drop_channel = channels.ndim == 0
+        channels = np.atleast_1d(channels)
+
+        shape = [len(range(s.start, s.stop, s.step)) for s in slices]
+        data = np.empty(shape + [len(channels)], dtype=self.dtype)
+        # Datasets are stored in ZYX order.
+        zyx = tuple(slices[::-1])
+        if data.size == 0:
+            pass
+        elif self.max_workers > 1 and self.direct_read and all(s.step == 1 for s in zyx):
+            datasets = [self.datasets[c] for c in channels]
+            read_parallel(datasets, zyx, data, self.max_workers)
+        else:
+            for ci, c in enumerate(channels):
+                data[..., ci] = self.datasets[c][zyx].transpose(2, 1, 0)
+
+        drop = list(drop) + [drop_channel]
+        return data[tuple(0 if d else slice(None) for d in drop)]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        return data
 
 
 class BaseReader:
 
-    def __init__(self, path):
+    #: Maximum distance (um) between spots of different markers for them to be
+    #: considered paired (see `get_neighbor_info`).
+    pairing_radius = 1.0
+
+    #: Dtype the tiles are stored in (e.g., 'uint8'). If None, the dtype of
+    #: the image is used. See `synaptogram.tilestore.TileCodec`.
+    tile_dtype = None
+
+    #: Number of worker processes used to compute the sort statistics and
+    #: features of large tile sets. If 0, they are computed in this process.
+    #: See `synaptogram.model.TiledNDImage.tile_workers`.
+    tile_workers = 0
+
+    def __init__(self, path, tile_dtype=None, tile_workers=None):
         self.path = Path(path)
+        if tile_dtype is not None:
+            self.tile_dtype = tile_dtype
+        if tile_workers is not None:
+            self.tile_workers = tile_workers
+
+    @property
+    def resolution_levels(self):
+        return [self.image]
+
+    @timed('reader.tile_info')
+    def get_tile_info(self, marker):
+        '''
+        Return table of spots for the marker
+
+        Includes the pairing with the spots of the other markers (see
+        `get_neighbor_info`).
+        '''
+        tile_info = self.points.to_frame(marker)
+        neighbors = get_neighbor_info(self.points, marker, self.pairing_radius)
+        for column in neighbors:
+            tile_info[column] = neighbors[column].values
+        return tile_info
 
-    def load(self):
-        marker = 'CtBP2'
-        return Points(
-                self.image_info,
-                self.image,
-                self.points.xs(marker, level='marker'),
-                self.get_point_volumes(marker),
-                )
+    def get_tiles(self, marker, size=10):
+        '''
+        Return tile information, tiles and `TileCodec` for the marker
+        '''
+        tiles = self.get_point_volumes(marker, size)
+        return (self.get_tile_info(marker), *self.encode_tiles(tiles))
+
+    @timed('reader.encode_tiles')
+    def encode_tiles(self, tiles):
+        '''
+        Convert tiles to `tile_dtype`
+
+        Returns the converted tiles and the codec that maps them back to
+        intensities.
+        '''
+        if self.tile_dtype is None or np.dtype(self.tile_dtype) == tiles.dtype:
+            return tiles, TileCodec.identity(tiles.dtype, tiles.shape[-1])
+        codec = TileCodec.fit(tiles, self.tile_dtype)
+        return codec.encode(tiles, self.tile_dtype), codec
+
+    def load(self, marker='CtBP2', size=10, progress=None):
+        '''
+        Load dataset
+
+        Parameters
+        ----------
+        marker : str
+            Name of spots to extract tiles for.
+        size : int
+            Size of tiles (in voxels).
+        progress : {None, callable}
+            If provided, called with a description of each stage as loading
+            progresses. May raise an exception to abort loading.
+        '''
+        if progress is None:
+            progress = lambda stage: None
+        start = time.perf_counter()
+        progress('Reading metadata')
+        with span('load.metadata'):
+            image_info = self.image_info
+            levels = self.resolution_levels
+        progress('Extracting tiles')
+        with span('load.tiles'):
+            tile_info, tiles, codec = self.get_tiles(marker, size)
+        progress('Sorting tiles')
+        with span('load.sort'):
+            # Tiles for the other markers are extracted when requested.
+            points = Points(image_info, self.image, tile_info, tiles, image_levels=levels,
+                            marker=marker, markers=self.points.markers,
+                            tile_loader=partial(self.get_tiles, size=size),
+                            tile_codec=codec, tile_workers=self.tile_workers)
+        progress('Reading channels')
+        with span('load.channels'):
+            # Ensure the data required to display the overview is loaded.
+            points.overview.get_z_projection(points.overview.n_levels - 1)
+        log.info('Loaded %s in %.2f s', self.path.name, time.perf_counter() - start)
+        return points
 
 
 class BaseImarisReader(BaseReader):
 
-    def __init__(self, path):
-        super().__init__(path)
-        self.fh = h5py.File(path, 'r')
+    #: Size of the HDF5 chunk cache (per dataset). Tiles are cut from the
+    #: volume a few voxels at a time, so this needs to be large enough to hold
+    #: the chunks spanning several z-planes to avoid decompressing the same
+    #: chunk repeatedly.
+    chunk_cache_size = 64 * 1024**2
+
+    #: Number of threads used to decompress the channels (see `ImarisVolume`).
+    read_workers = min(8, os.cpu_count() or 1)
+
+    def __init__(self, path, read_workers=None, tile_dtype=None, tile_workers=None):
+        super().__init__(path, tile_dtype, tile_workers)
+        if read_workers is not None:
+            self.read_workers = read_workers
+        self.fh = h5py.File(path, 'r', rdcc_nbytes=self.chunk_cache_size,
+                            rdcc_nslots=10007)
+
+    def close(self):
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     @cached_property
     def points(self):
-        points = []
-        keys = []
+        nodes = []
         for i, (name, node) in enumerate(self.fh['Scene/Content'].items()):
             if name.startswith('Points'):
-                p = extract_points(node)
-                points.append(p)
-                keys.append((i, node.attrs['Name'][0].decode('utf')))
-        points = pd.concat(points, keys=keys, names=['node_index', 'marker', 'i'])
-        for d, dim in enumerate('xyz'):
-            origin = self.image_info['lower'][d]
-            size = self.image_info['voxel_size'][d]
-            i = (points[dim] - origin) / size
-            points[f'{dim}i'] = i.round().astype('i')
-        return points
+                marker = node.attrs['Name'][0].decode('utf')
+                nodes.append((i, marker, extract_points(node)))
+        return PointTable.from_nodes(nodes, self.image_info['lower'],
+                                     self.image_info['voxel_size'])
 
     @cached_property
     def image_info(self):
@@ -99,16 +595,12 @@ class BaseImarisReader(BaseReader):
         }
 
     @cached_property
-    def image(self):
-        data = []
-        for channel_node in self.fh['DataSet/ResolutionLevel 0/TimePoint 0'].values():
-            data.append(channel_node['Data'][:][..., np.newaxis])
-        data = np.concatenate(data, axis=-1)
-
-        # FIgure out sort order of channels to go from lowest to highest
+    def channel_order(self):
+        # Figure out sort order of channels to go from lowest to highest
         # emission wavelength.
+        n_channels = len(self.fh['DataSet/ResolutionLevel 0/TimePoint 0'])
         emission = []
-        for i in range(data.shape[-1]):
+        for i in range(n_channels):
             c_attrs = self.fh[f'DataSetInfo/Channel {i}'].attrs
             e = extract_str(c_attrs, 'LSMEmissionWavelength')
             if '-' in e:
@@ -116,31 +608,40 @@ class BaseImarisReader(BaseReader):
             else:
                 e = float(e)
             emission.append(e)
-        i = np.argsort(emission)
+        return np.argsort(emission).tolist()
 
-        x, y, z = self.image_info['n_voxels']
-        return data[:z, :y, :x, i].swapaxes(0, 2)
+    def get_volume(self, level=0):
+        node = self.fh[f'DataSet/ResolutionLevel {level}/TimePoint 0']
+        channels = list(node.values())
+        if level == 0:
+            n_voxels = self.image_info['n_voxels']
+        else:
+            # Imaris stores the unpadded size of each level as attributes of
+            # the channel. If missing, scale the size of the full-resolution
+            # image by the ratio of the (padded) dataset shapes.
+            attrs = channels[0].attrs
+            try:
+                n_voxels = [int(extract_value(attrs, f'ImageSize{d}')) for d in 'XYZ']
+            except KeyError:
+                ds0 = self.fh['DataSet/ResolutionLevel 0/TimePoint 0/Channel 0/Data'].shape[::-1]
+                ds = channels[0]['Data'].shape[::-1]
+                n_voxels = [int(np.ceil(n * s / s0)) for n, s, s0 in zip(self.image_info['n_voxels'], ds, ds0)]
+        datasets = [channels[i]['Data'] for i in self.channel_order]
+        return ImarisVolume(datasets, n_voxels, self.read_workers)
+
+    @cached_property
+    def image(self):
+        return self.get_volume(0)
 
+    @cached_property
+    def resolution_levels(self):
+        n_levels = sum(1 for k in self.fh['DataSet'] if k.startswith('ResolutionLevel'))
+        return [self.image] + [self.get_volume(l) for l in range(1, n_levels)]
+
+    @timed('reader.extract_tiles')
     def get_point_volumes(self, point_name, size=10):
-        spots = []
-        xyz_max = self.image.shape[:-1]
-        points = self.points.xs(point_name, level='marker')
-        volumes = []
-        lower = int(np.ceil(size / 2))
-        upper = int(np.floor(size / 2))
-        for _, point in points.iterrows():
-            i = point[['xi', 'yi', 'zi']].abs().astype('i').values
-            lb = np.clip(i - lower, 0, xyz_max)
-            ub = np.clip(i + upper, 0, xyz_max)
-            s = np.s_[*[slice(l, u) for l, u in zip(lb, ub)]]
-            image = self.image[s]
-
-            padding = size - np.array(image.shape[:-1])
-            if np.any(padding):
-                padding = list(zip(np.zeros_like(padding), padding)) + [(0, 0)]
-                image = np.pad(image, padding)
-            volumes.append(image[np.newaxis])
-        return np.concatenate(volumes, axis=0)
+        points = self.points.get_marker(point_name)
+        return extract_tiles(self.image, points.voxels, size)
 
 
 P_FILENAME = re.compile('.*63x-((?:\w+-?)*)_IHC_\d+.*')
@@ -148,21 +649,48 @@ P_FILENAME = re.compile('.*63x-((?:\w+-?)*)_IHC_\d+.*')
 
 class ImarisReader(BaseImarisReader):
 
+    def __init__(self, path, cache=True, read_workers=None, tile_dtype=None,
+                 tile_workers=None):
+        super().__init__(path, read_workers, tile_dtype, tile_workers)
+        if cache is True:
+            cache = TileCache(self.path.parent / '.synaptogram-cache')
+        self.cache = cache or None
+
+    def get_tiles(self, marker, size=10):
+        if self.cache is None:
+            return super().get_tiles(marker, size)
+        tile_dtype = None if self.tile_dtype is None else np.dtype(self.tile_dtype).str
+        name, params = self.cache.get_key(self.path, marker=marker, size=size,
+                                          pairing_radius=self.pairing_radius,
+                                          tile_dtype=tile_dtype)
+        if (result := self.cache.load(name)) is not None:
+            tiles, tile_info, image_info, codec = result
+            if image_info['channels'] == self.image_info['channels']:
+                return tile_info, tiles, codec
+        tile_info, tiles, codec = super().get_tiles(marker, size)
+        try:
+            self.cache.save(name, params, tiles, tile_info, self.image_info, codec)
+        except OSError as e:
+            log.warning('Unable to save tiles to cache: %s', e)
+            return tile_info, tiles, codec
+        # Use the memory-mapped tiles from the cache so that they can be
+        # shared with worker processes (see `synaptogram.tilestore`).
+        if (result := self.cache.load(name)) is not None:
+            tiles = result[0]
+        return tile_info, tiles, codec
+
     def save_state(self, obj, state):
-        filename = self.path.with_suffix('.json')
-        filename.write_text(json.dumps(state, indent=4))
+        write_state(self.path.with_suffix('.json'), state)
+
+    def append_state(self, obj, entry):
+        append_journal(self.path.with_suffix('.json'), entry)
 
     def load_state(self, obj):
-        filename = self.path.with_suffix('.json')
-        return json.loads(filename.read_text())
+        return read_state(self.path.with_suffix('.json'))
 
     @cached_property
     def points(self):
-        points = super().points
-        names = points.index.names[:]
-        points = points.reset_index()
-        points['marker'] = points['marker'].map(lambda x: 'CtBP2' if x == 'Spots 1' else x)
-        return points.set_index(names)
+        return super().points.rename_markers({'Spots 1': 'CtBP2'})
 
     @cached_property
     def channel_names(self):
@@ -0,0 +1,65 @@
+'''
+Redraw scheduling shared by the presenters
+'''
+import logging
+import time
+
+from atom.api import Atom, Bool, Dict, Float, Int
+from enaml.application import deferred_call, timed_call
+import numpy as np
+
+from .instrument import timed
+
+log = logging.getLogger(__name__)
+
+
+class RedrawScheduler(Atom):
+    '''
+    Merges redraw requests from the presenters into frames
+
+    Requests made before the next frame is drawn are merged so that each
+    presenter is drawn at most once per frame. Frames are spaced at least
+    `interval` ms apart (i.e., roughly the refresh rate of the display) so that
+    a burst of events (e.g., holding down an arrow key) does not queue up a
+    backlog of full redraws. A presenter can request a blit if only its
+    animated artists changed. This is upgraded to a full redraw if both are
+    requested in the same frame.
+    '''
+    #: Minimum time between frames (ms)
+    interval = Int(16)
+
+    #: Presenters to update in the next frame, mapped to True if a full redraw
+    #: is needed and False if a blit is sufficient.
+    pending = Dict()
+
+    frame_scheduled = Bool(False)
+    last_frame = Float()
+
+    def request(self, presenter, full=True):
+        self.pending[presenter] = full or self.pending.get(presenter, False)
+        if self.frame_scheduled:
+            return
+        self.frame_scheduled = True
+        delay = self.interval - (time.perf_counter() - self.last_frame) * 1e3
+        if delay > 0:
+            timed_call(int(np.ceil(delay)), self.draw_frame)
+        else:
+            deferred_call(self.draw_frame)
+
+    @timed('redraw.frame')
+    def draw_frame(self):
+        self.last_frame = time.perf_counter()
+        pending, self.pending = self.pending, {}
+        self.frame_scheduled = False
+        for presenter, full in pending.items():
+            try:
+                if full:
+                    presenter.redraw_if_needed()
+                else:
+                    presenter.blit()
+            except Exception as e:
+                log.exception(e)
+
+
+#: Scheduler shared by all presenters unless one is provided.
+scheduler = RedrawScheduler()
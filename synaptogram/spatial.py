@@ -0,0 +1,140 @@
+'''
+Spatial index over spots for neighbor queries
+'''
+import itertools
+
+import numpy as np
+import pandas as pd
+
+
+class SpatialIndex:
+    '''
+    Uniform grid over a set of points
+
+    Points are binned into cubic cells of `cell_size` (um) and sorted by cell
+    so that the points in a cell are a contiguous range. A query only compares
+    against the points in the cells surrounding the query point. All queries
+    are batched (i.e., they accept an N x 3 array of query points). Queries
+    are fastest when the radius is close to `cell_size`.
+    '''
+
+    def __init__(self, points, cell_size=1.0):
+        self.points = np.asarray(points, dtype='float64').reshape(-1, 3)
+        self.cell_size = cell_size
+        cells = np.floor(self.points / cell_size).astype('int64')
+        if len(cells):
+            self.origin = cells.min(axis=0)
+            self.shape = cells.max(axis=0) - self.origin + 1
+        else:
+            self.origin = np.zeros(3, dtype='int64')
+            self.shape = np.ones(3, dtype='int64')
+        keys = self._cell_keys(cells - self.origin)
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+
+    def __len__(self):
+        return len(self.points)
+
+    def _cell_keys(self, cells):
+        return (cells[..., 0] * self.shape[1] + cells[..., 1]) * self.shape[2] + cells[..., 2]
+
+    def _candidates(self, queries, radius):
+        # Return (query index, point index) for all points in the cells that
+        # may contain points within radius of each query.
+        n = int(np.ceil(radius / self.cell_size))
+        offsets = np.array(list(itertools.product(range(-n, n + 1), repeat=3)))
+        cells = np.floor(queries / self.cell_size).astype('int64') - self.origin
+        cells = cells[:, np.newaxis] + offsets
+        valid = np.all((cells >= 0) & (cells < self.shape), axis=-1)
+        query_index = np.nonzero(valid)[0]
+        keys = self._cell_keys(cells[valid])
+        lb = np.searchsorted(self.keys, keys, 'left')
+        ub = np.searchsorted(self.keys, keys, 'right')
+        counts = ub - lb
+        query_index = np.repeat(query_index, counts)
+        # Position of each candidate in the sorted keys
+        starts = np.repeat(lb - (np.cumsum(counts) - counts), counts)
+        position = starts + np.arange(len(starts))
+        return query_index, self.order[position]
+
+    def query_radius(self, queries, radius):
+        '''
+        Find all points within radius of the queries
+
+        Returns arrays of query index, point index and distance for each
+        match.
+        '''
+        queries = np.asarray(queries, dtype='float64').reshape(-1, 3)
+        qi, pi = self._candidates(queries, radius)
+        distance = np.linalg.norm(self.points[pi] - queries[qi], axis=-1)
+        mask = distance <= radius
+        return qi[mask], pi[mask], distance[mask]
+
+    def count_neighbors(self, queries, radius):
+        '''
+        Count the points within radius of each query
+        '''
+        qi, _, _ = self.query_radius(queries, radius)
+        return np.bincount(qi, minlength=len(queries))
+
+    def query_nearest(self, queries, max_distance):
+        '''
+        Find the nearest point to each query
+
+        Only points within `max_distance` are considered. Returns the distance
+        (NaN if there is no point within `max_distance`) and the index (-1 if
+        there is no point) of the nearest point.
+        '''
+        queries = np.asarray(queries, dtype='float64').reshape(-1, 3)
+        qi, pi, d = self.query_radius(queries, max_distance)
+        # Sort the matches by query and then distance so that the first match
+        # for each query is the nearest.
+        order = np.lexsort((d, qi))
+        qi, pi, d = qi[order], pi[order], d[order]
+        first = np.r_[True, qi[1:] != qi[:-1]] if len(qi) else np.zeros(0, dtype=bool)
+        distance = np.full(len(queries), np.nan)
+        index = np.full(len(queries), -1)
+        distance[qi[first]] = d[first]
+        index[qi[first]] = pi[first]
+        return distance, index
+
+
+def get_neighbor_info(points, marker, radius=1.0):
+    '''
+    Find the spots of the other markers near each spot of the marker
+
+    Parameters
+    ----------
+    points : PointTable
+        Spots for all markers.
+    marker : str
+        Marker to find neighbors for.
+    radius : float
+        Maximum distance (um) between paired spots.
+
+    Returns
+    -------
+    DataFrame with one row per spot of the marker (in the same order as
+    `points.get_marker(marker)`) containing the number of spots of each other
+    marker within radius (`{other}_count`), the distance to the nearest one
+    (`{other}_distance`, NaN if none are within radius) and a flag indicating
+    the spot is an orphan candidate (i.e., it is not paired with a spot from
+    any of the other markers). Empty if there are no other markers.
+    '''
+    queries = points.get_marker(marker).values[:, :3]
+    info = {}
+    paired = np.zeros(len(queries), dtype=bool)
+    for other in points.markers:
+        if other == marker:
+            continue
+        index = SpatialIndex(points.get_marker(other).values[:, :3], radius)
+        qi, _, d = index.query_radius(queries, radius)
+        distance = np.full(len(queries), np.inf)
+        np.minimum.at(distance, qi, d)
+        distance[np.isinf(distance)] = np.nan
+        info[f'{other}_count'] = np.bincount(qi, minlength=len(queries))
+        info[f'{other}_distance'] = distance
+        paired |= ~np.isnan(distance)
+    if info:
+        info['orphan_candidate'] = ~paired
+    return pd.DataFrame(info, index=pd.RangeIndex(len(queries)))
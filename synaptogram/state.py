@@ -0,0 +1,153 @@
+'''
+Saved analyses: a snapshot plus an append-only journal of label edits
+
+The snapshot (`.json`) stores the tile indices for each label. Saving appends
+the label edits made since the last save to the journal (`.journal`, one JSON
+entry per line) rather than rewriting the snapshot, so the cost of saving
+depends on the number of edits, not the number of labeled tiles. The journal
+is periodically compacted into a new snapshot.
+
+Each journal entry contains:
+
+* generation - generation of the snapshot the entry applies to.
+* edits - list of (op, label, tile index) where op is 'add' or 'remove'.
+* overview - state of the overview at the time of the save.
+* history - user, host and time of the save.
+
+Each snapshot is given a new generation (`meta['generation']`). The journal is
+removed after the snapshot is replaced, so if the program is interrupted in
+between, the journal still holds entries that were already compacted into the
+snapshot. These are skipped when loading since they are from an older
+generation.
+'''
+import json
+import logging
+import os
+from pathlib import Path
+import uuid
+
+log = logging.getLogger(__name__)
+
+
+JOURNAL_SUFFIX = '.journal'
+
+
+def journal_path(path):
+    return Path(path).with_suffix(JOURNAL_SUFFIX)
+
+
+def is_saved_label(label):
+    '''
+    True if the label is saved (the selection and suggestions are not)
+    '''
+    return label != 'selected' and not label.startswith('suggested_')
+
+
+def apply_label_edits(labels, edits):
+    '''
+    Apply edits to a dictionary mapping each label to a set of tile indices
+    '''
+    for op, label, i in edits:
+        if op == 'add':
+            labels.setdefault(label, set()).add(int(i))
+        elif op == 'remove':
+            labels.get(label, set()).discard(int(i))
+        else:
+            raise ValueError(f'Unknown label edit "{op}"')
+    return labels
+
+
+def write_state(path, state):
+    '''
+    Write snapshot and discard the journal
+
+    The snapshot is assigned a new generation (stored in
+    `state['meta']['generation']`). Journal entries appended after this must
+    include it. The snapshot is written to a temporary file first so that the
+    previous snapshot is intact if writing fails.
+    '''
+    path = Path(path)
+    state.setdefault('meta', {})['generation'] = uuid.uuid4().hex
+    tmp_path = path.with_name(path.name + '.tmp')
+    tmp_path.write_text(json.dumps(state, indent=4))
+    os.replace(tmp_path, path)
+    journal_path(path).unlink(missing_ok=True)
+
+
+def append_journal(path, entry):
+    '''
+    Append entry to the journal
+    '''
+    with journal_path(path).open('a+b') as fh:
+        # Start a new line if the last entry is incomplete so that this entry
+        # can be read.
+        if fh.seek(0, os.SEEK_END) > 0:
+            fh.seek(-1, os.SEEK_END)
+            if fh.read(1) != b'\n':
+                fh.write(b'\n')
+        fh.write(json.dumps(entry).encode() + b'\n')
+        fh.flush()
+        os.fsync(fh.fileno())
+
+
+def read_journal(path):
+    '''
+    Read entries in the journal
+
+    An incomplete last line (e.g., the program crashed while saving) is
+    skipped.
+    '''
+    path = journal_path(path)
+    if not path.exists():
+        return []
+    entries = []
+    for line in path.read_text().splitlines():
+        if not line.strip():
+            continue
+        try:
+            entries.append(json.loads(line))
+        except json.JSONDecodeError:
+            log.warning('Skipping incomplete entry in %s', path)
+    return entries
+
+
+def read_state(path):
+    '''
+    Read snapshot and the entries in the journal
+
+    The journal entries are returned in `state['journal']` (see
+    `merge_journal`).
+    '''
+    state = json.loads(Path(path).read_text())
+    state['journal'] = read_journal(path)
+    return state
+
+
+def merge_journal(state):
+    '''
+    Apply the journal entries to the snapshot
+
+    Entries from an older generation than the snapshot are skipped. Labels
+    are converted to sorted lists of tile indices. Older analyses that saved
+    the tile information for each label (i.e., a dictionary keyed by the tile
+    index) are converted as well.
+    '''
+    journal = state.pop('journal', [])
+    data = state['data']
+    labels = {l: {int(i) for i in indices} for l, indices in data['points']['labels'].items()}
+    meta = state.setdefault('meta', {})
+    history = meta.setdefault('history', [])
+    generation = meta.get('generation', '')
+    stale = [e for e in journal if e.get('generation', '') != generation]
+    if stale:
+        log.warning('Skipping %d journal entries already in the snapshot', len(stale))
+    for entry in journal:
+        if entry.get('generation', '') != generation:
+            continue
+        apply_label_edits(labels, entry.get('edits', []))
+        if 'overview' in entry:
+            data['overview'] = entry['overview']
+        if 'history' in entry:
+            history.append(entry['history'])
+    data['points']['labels'] = {l: sorted(i) for l, i in labels.items() if is_saved_label(l)}
+    return state
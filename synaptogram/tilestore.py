@@ -0,0 +1,264 @@
+'''
+Storage of the tiles
+
+The tiles are stored as an N x X x Y x Z x C array in a `.npy` file (e.g., the
+file in the tile cache). Worker processes attach to the file by name, so the
+operating system shares the pages between processes rather than copying the
+tiles to each worker. Tiles may be stored in a smaller dtype than the image,
+in which case a `TileCodec` maps the stored values back to intensities.
+
+    store = TileStore.from_array(tiles, channel_names)
+    stats = map_tiles(partial(masked_statistic, mask=mask, statistic='max'), store)
+
+`synaptogram.model.masked_statistic` and `synaptogram.classify.extract_features`
+do this when passed a `TileStore`.
+'''
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import repeat
+import logging
+import multiprocessing
+from pathlib import Path
+import tempfile
+import weakref
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+def _remove(path):
+    try:
+        Path(path).unlink(missing_ok=True)
+    except OSError as e:
+        # On Windows, the file cannot be removed while it is still mapped.
+        log.warning('Unable to remove %s: %s', path, e)
+
+
+def _memmap_file(tiles):
+    # Return the file if the array is a memory-mapped view of an entire
+    # `.npy` file (e.g., as loaded from the tile cache).
+    if not isinstance(tiles, np.memmap) or tiles.filename is None \
+            or not tiles.flags.c_contiguous:
+        return None
+    path = Path(tiles.filename)
+    if path.suffix != '.npy':
+        return None
+    mapped = np.load(path, mmap_mode='r')
+    if mapped.shape != tiles.shape or mapped.dtype != tiles.dtype \
+            or mapped.offset != tiles.offset:
+        return None
+    return path
+
+
+def dtype_max(dtype):
+    '''
+    Maximum intensity for the dtype (1 for floating point)
+    '''
+    dtype = np.dtype(dtype)
+    return float(np.iinfo(dtype).max) if dtype.kind in 'ui' else 1.0
+
+
+class TileCodec:
+    '''
+    Maps stored tile values to intensities
+
+    Each channel is stored as `(intensity - offset) / scale` rounded to the
+    storage dtype. `source_max` is the maximum intensity of the image dtype
+    (used to normalize intensities to the range 0 to 1).
+    '''
+
+    def __init__(self, scale, offset, source_max):
+        self.scale = np.asarray(scale, dtype='float32')
+        self.offset = np.asarray(offset, dtype='float32')
+        self.source_max = float(source_max)
+
+    @classmethod
+    def identity(cls, dtype, n_channels):
+        '''
+        Codec for tiles stored in the dtype of the image
+        '''
+        return cls(np.ones(n_channels), np.zeros(n_channels), dtype_max(dtype))
+
+    @classmethod
+    def fit(cls, tiles, dtype):
+        '''
+        Codec that spans the range of each channel of the tiles in `dtype`
+
+        The scale is 1 (i.e., no loss of precision) if the range fits.
+        '''
+        dtype = np.dtype(dtype)
+        n_channels = tiles.shape[-1]
+        if dtype.kind not in 'ui' or len(tiles) == 0:
+            return cls.identity(tiles.dtype, n_channels)
+        # Reducing across tiles first is much faster than reducing each
+        # channel directly (which has a short inner loop).
+        values = tiles.reshape((len(tiles), -1))
+        lb = values.min(axis=0).reshape((-1, n_channels)).min(axis=0).astype('float64')
+        ub = values.max(axis=0).reshape((-1, n_channels)).max(axis=0).astype('float64')
+        scale = (ub - lb) / np.iinfo(dtype).max
+        if tiles.dtype.kind in 'ui':
+            scale = np.maximum(scale, 1)
+        scale[scale == 0] = 1
+        return cls(scale, lb, dtype_max(tiles.dtype))
+
+    @property
+    def is_identity(self):
+        return bool(np.all(self.scale == 1) and np.all(self.offset == 0))
+
+    def encode(self, tiles, dtype, batch_size=256):
+        '''
+        Convert tiles to the storage dtype
+
+        Tiles are converted in small batches so that the temporary arrays fit
+        in the CPU cache.
+        '''
+        dtype = np.dtype(dtype)
+        if self.is_identity:
+            return tiles.astype(dtype, copy=False)
+        info = np.iinfo(dtype)
+        inverse = 1 / self.scale
+        encoded = np.empty(tiles.shape, dtype=dtype)
+        for lb in range(0, len(tiles), batch_size):
+            t = tiles[lb:lb+batch_size].astype('float32')
+            t -= self.offset
+            t *= inverse
+            np.rint(t, out=t)
+            np.clip(t, info.min, info.max, out=t)
+            encoded[lb:lb+batch_size] = t
+        return encoded
+
+    def decode(self, values, normalize=False):
+        '''
+        Return intensities (float32) of stored values
+
+        The last axis of `values` must be the channel. If `normalize` is True,
+        intensities are divided by `source_max`.
+        '''
+        values = values.astype('float32')
+        if not self.is_identity:
+            values *= self.scale
+            values += self.offset
+        if normalize:
+            values /= self.source_max
+        return values
+
+    def to_dict(self):
+        return {
+            'scale': self.scale.tolist(),
+            'offset': self.offset.tolist(),
+            'source_max': self.source_max,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['scale'], d['offset'], d['source_max'])
+
+
+class TileStore:
+    '''
+    Read-only tiles in a memory-mapped `.npy` file
+
+    Parameters
+    ----------
+    path : path
+        File containing the tiles.
+    channel_names : {None, list of str}
+        Name of each channel in the last axis of the tiles.
+    codec : {None, TileCodec}
+        Maps the stored values to intensities.
+    temporary : bool
+        If True, the file is removed once the store is no longer referenced.
+    '''
+
+    def __init__(self, path, channel_names=None, codec=None, temporary=False):
+        self.path = Path(path)
+        self.tiles = np.load(self.path, mmap_mode='r')
+        self.channel_names = None if channel_names is None else list(channel_names)
+        if codec is None:
+            codec = TileCodec.identity(self.tiles.dtype, self.tiles.shape[-1])
+        self.codec = codec
+        if temporary:
+            weakref.finalize(self, _remove, self.path)
+
+    @classmethod
+    def from_array(cls, tiles, channel_names=None, codec=None, directory=None):
+        '''
+        Create store for the tiles
+
+        If the tiles are already memory-mapped from a `.npy` file, the file is
+        used directly. Otherwise, the tiles are written to a temporary file in
+        `directory` (defaults to the system temporary folder).
+        '''
+        if (path := _memmap_file(tiles)) is not None:
+            return cls(path, channel_names, codec)
+        fh = tempfile.NamedTemporaryFile(prefix='synaptogram-tiles-', suffix='.npy',
+                                         dir=directory, delete=False)
+        with fh:
+            np.save(fh, np.ascontiguousarray(tiles))
+        return cls(fh.name, channel_names, codec, temporary=True)
+
+    @property
+    def spec(self):
+        '''
+        Layout of the tiles (used by `attach`)
+        '''
+        return {
+            'path': str(self.path),
+            'shape': list(self.tiles.shape),
+            'dtype': self.tiles.dtype.str,
+            'channel_names': self.channel_names,
+            'codec': self.codec.to_dict(),
+        }
+
+    @staticmethod
+    def attach(spec):
+        '''
+        Map tiles described by `spec` (e.g., in a worker process)
+
+        Raises ValueError if the file no longer matches the layout.
+        '''
+        tiles = np.load(spec['path'], mmap_mode='r')
+        if list(tiles.shape) != list(spec['shape']) or tiles.dtype.str != spec['dtype']:
+            raise ValueError(f'Layout of {spec["path"]} does not match the tile store')
+        return tiles
+
+    def __len__(self):
+        return len(self.tiles)
+
+
+def _apply(fn, spec, bounds):
+    lb, ub = bounds
+    return fn(TileStore.attach(spec)[lb:ub])
+
+
+@lru_cache
+def shared_executor(max_workers):
+    '''
+    Process pool shared by the models (started on first use)
+
+    Workers are spawned rather than forked since the GUI process has other
+    threads running (e.g., the dataset loader).
+    '''
+    return ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def map_tiles(fn, store, batch_size=4096, max_workers=None, executor=None):
+    '''
+    Apply `fn` to batches of tiles in worker processes
+
+    `fn` must be picklable (e.g., a module-level function or a
+    `functools.partial` of one) and return an array with one row per tile.
+    Results are concatenated in the order of the tiles. Pass a
+    `ProcessPoolExecutor` as `executor` to reuse its workers across calls
+    (otherwise, a pool of `max_workers` processes is started for the call).
+    '''
+    n = len(store)
+    bounds = [(lb, min(lb + batch_size, n)) for lb in range(0, n, batch_size)]
+    if not bounds:
+        return fn(store.tiles)
+    if executor is None:
+        with ProcessPoolExecutor(max_workers) as executor:
+            return map_tiles(fn, store, batch_size, executor=executor)
+    results = executor.map(_apply, repeat(fn), repeat(store.spec), bounds)
+    return np.concatenate(list(results))
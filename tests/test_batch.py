@@ -0,0 +1,36 @@
+import os
+
+import pandas as pd
+
+from synaptogram import batch
+
+
+def fake_process_file(path, output, **kwargs):
+    # Stand-in for `batch.process_file` that does not need real Imaris files.
+    if path.stem == 'killed':
+        os._exit(1)
+    if path.stem == 'corrupt':
+        raise ValueError('Unable to read file')
+    return {'path': str(path), 'status': 'ok', 'error': '', 'time_total': 0,
+            'max_rss_mb': batch.max_rss_mb()}
+
+
+def test_failed_workers_in_summary(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, 'process_file', fake_process_file)
+    # Files are processed in order, so `corrupt` is done before the worker
+    # processing `killed` exits.
+    for name in ('corrupt', 'killed'):
+        (tmp_path / f'{name}.ims').touch()
+    output = tmp_path / 'output'
+    assert batch.main([str(tmp_path), '-o', str(output), '-j', '1']) == 1
+
+    summary = pd.read_csv(output / 'summary.csv').set_index('path')
+    assert list(summary['status']) == ['failed', 'failed']
+    assert 'Worker process died' in summary.loc[str(tmp_path / 'killed.ims'), 'error']
+    assert summary.loc[str(tmp_path / 'corrupt.ims'), 'error'] == 'Unable to read file'
+
+
+def test_max_rss(monkeypatch):
+    assert batch.max_rss_mb() > 0
+    monkeypatch.setattr(batch.sys, 'platform', 'win32')
+    assert pd.isna(batch.max_rss_mb())
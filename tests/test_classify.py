@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from synaptogram.classify import (
+    extract_features, get_features, get_saved_labels, LabelClassifier, load_training_data
+)
+from synaptogram.state import write_state
+
+
+def make_spots(n=20, size=7, seed=0):
+    # Dim background with a bright spot in the center of each tile. The second
+    # channel is a copy of the first.
+    rng = np.random.default_rng(seed)
+    tiles = rng.integers(0, 20, size=(n, size, size, size, 1), dtype='uint16')
+    c = size // 2
+    tiles[:, c-1:c+2, c-1:c+2, c-1:c+2] += 1000
+    return np.concatenate([tiles, tiles], axis=-1)
+
+
+def make_dataset(n=200, seed=0):
+    # Two features that separate the three classes.
+    rng = np.random.default_rng(seed)
+    labels = np.array(['none', 'artifact', 'orphan'])[rng.integers(0, 3, size=n)]
+    centers = {'none': (0, 0), 'artifact': (5, 0), 'orphan': (0, 5)}
+    x = np.array([centers[l] for l in labels]) + rng.normal(scale=0.5, size=(n, 2))
+    return pd.DataFrame(x, columns=['a', 'b']), labels
+
+
+class FakeReader:
+
+    def __init__(self, channels, n=20):
+        self.tiles = make_spots(n)
+        self.image_info = {
+            'voxel_size': [0.1, 0.1, 0.1],
+            'channels': [{'name': c} for c in channels],
+        }
+        self.closed = False
+
+    def get_tiles(self, marker, size):
+        tile_info = pd.DataFrame({'GlueR2_count': np.ones(len(self.tiles)),
+                                  'GlueR2_distance': np.full(len(self.tiles), np.nan)})
+        return tile_info, self.tiles, None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.closed = True
+
+
+def test_extract_features():
+    features = extract_features(make_spots(), radius=1.5, channel_names=['GluR2', 'CtBP2'])
+    assert len(features) == 20
+    assert (features['GluR2_mean'] > features['GluR2_background']).all()
+    assert (features['GluR2_contrast'] > 0.9).all()
+    # The spot is centered in the tile.
+    np.testing.assert_allclose(features['GluR2_offset'], 0, atol=0.1)
+    np.testing.assert_allclose(features['GluR2_CtBP2_correlation'], 1, atol=1e-4)
+
+
+def test_features_use_canonical_names():
+    tiles = make_spots()
+    tile_info = pd.DataFrame({'GlueR2_count': np.ones(len(tiles))})
+    features = get_features(tiles, tile_info, 0.1, ['GlueR2', 'CtBP2'])
+    expected = get_features(tiles, tile_info.rename(columns={'GlueR2_count': 'GluR2_count'}),
+                            0.1, ['GluR2', 'CtBP2'])
+    assert 'GluR2_mean' in features and 'GluR2_count' in features
+    assert 'GlueR2_mean' not in features
+    pd.testing.assert_frame_equal(features, expected)
+
+
+def test_classifier_separates_classes():
+    features, labels = make_dataset()
+    classifier = LabelClassifier().fit(features, labels)
+    predicted = np.array(classifier.predict(features), dtype=object)
+    predicted[predicted == None] = 'none'
+    assert (predicted == labels).mean() > 0.95
+
+
+def test_classifier_save_load(tmp_path):
+    features, labels = make_dataset()
+    classifier = LabelClassifier().fit(features, labels)
+    classifier.save(tmp_path / 'classifier.npz')
+    loaded = LabelClassifier.load(tmp_path / 'classifier.npz')
+    assert loaded.feature_names == classifier.feature_names
+    np.testing.assert_array_equal(loaded.predict_proba(features),
+                                  classifier.predict_proba(features))
+    assert loaded.predict(features) == classifier.predict(features)
+
+
+def test_classifier_missing_features():
+    features, labels = make_dataset()
+    classifier = LabelClassifier().fit(features, labels)
+    with pytest.raises(ValueError, match='Missing features b'):
+        classifier.predict(features[['a']])
+
+
+def test_get_saved_labels():
+    state = {'data': {'points': {'labels': {'artifact': [1, '3'], 'orphan': [0],
+                                            'other': [2]}}}}
+    labels = get_saved_labels(state, 5)
+    assert labels.tolist() == ['orphan', 'artifact', 'none', 'artifact', 'none']
+
+
+def test_training_data_across_spellings(tmp_path):
+    readers = {}
+    for name, channels in (('a', ['GluR2', 'CtBP2']), ('b', ['GlueR2', 'CtBP2'])):
+        write_state(tmp_path / f'{name}.json', {
+            'data': {'points': {'labels': {'artifact': [0]}}, 'overview': {}},
+            'meta': {'history': []},
+        })
+        (tmp_path / f'{name}.ims').touch()
+        readers[f'{name}.ims'] = FakeReader(channels)
+
+    paths = [tmp_path / 'a.json', tmp_path / 'b.json']
+    features, labels = load_training_data(paths, lambda p: readers[p.name])
+    assert len(features) == 40
+    assert not features.isna().any().any()
+    assert (labels == 'artifact').sum() == 2
+    assert all(r.closed for r in readers.values())
+
+    readers['b.ims'] = FakeReader(['MyosinVIIa', 'CtBP2'])
+    with pytest.raises(ValueError, match='b.ims do not match'):
+        load_training_data(paths, lambda p: readers[p.name])
@@ -0,0 +1,165 @@
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+
+from ndimage_enaml.util import get_image
+
+from synaptogram.config import CHANNEL_CONFIG
+from synaptogram.model import VolumeNDImage
+from synaptogram.reader import extract_tiles, ImarisVolume, POINT_COLUMNS, PointTable
+
+
+LOWER = np.array([-2.0, 1.0, 0.5])
+VOXEL_SIZE = np.array([0.1, 0.1, 0.2])
+
+
+def extract_tiles_loop(volume, indices, size):
+    # Per-point extraction that zero-pads tiles at the upper end of each axis
+    # (the implementation prior to batching).
+    xyz_max = volume.shape[:-1]
+    lower = int(np.ceil(size / 2))
+    upper = int(np.floor(size / 2))
+    tiles = []
+    for i in np.abs(indices).astype('i'):
+        lb = np.clip(i - lower, 0, xyz_max)
+        ub = np.clip(i + upper, 0, xyz_max)
+        tile = volume[tuple(slice(l, u) for l, u in zip(lb, ub))]
+        padding = [(0, size - n) for n in tile.shape[:-1]] + [(0, 0)]
+        tiles.append(np.pad(tile, padding))
+    return np.stack(tiles)
+
+
+def make_volume(shape=(40, 30, 12, 2), seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(1, 2**16, size=shape, dtype='uint16')
+
+
+def make_indices(shape, n=200, seed=1):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, shape[:-1], size=(n, 3))
+
+
+@pytest.mark.parametrize('size', [5, 6])
+def test_extract_tiles(size):
+    volume = make_volume()
+    indices = make_indices(volume.shape)
+    np.testing.assert_array_equal(extract_tiles(volume, indices, size),
+                                  extract_tiles_loop(volume, indices, size))
+
+
+def test_extract_tiles_edge():
+    # Tiles at each corner and face of the volume are clipped.
+    volume = make_volume()
+    x, y, z = np.array(volume.shape[:-1]) - 1
+    indices = np.array([
+        [0, 0, 0], [x, y, z], [0, y, z], [x, 0, 0], [1, 1, 1],
+        [x - 1, y - 1, z - 1], [20, 0, 6], [20, y, 6], [0, 15, z],
+    ])
+    tiles = extract_tiles(volume, indices, 6)
+    np.testing.assert_array_equal(tiles, extract_tiles_loop(volume, indices, 6))
+    # The tile at the upper corner only has the voxels up to the edge.
+    assert tiles[1, :4, :4, :4].all()
+    assert not tiles[1, 4:].any() and not tiles[1, :, 4:].any() and not tiles[1, :, :, 4:].any()
+
+
+def test_extract_tiles_small_blocks():
+    # The block cap is smaller than a single tile.
+    volume = make_volume()
+    indices = make_indices(volume.shape, 50)
+    tiles = extract_tiles(volume, indices, 6, max_block_bytes=64)
+    np.testing.assert_array_equal(tiles, extract_tiles_loop(volume, indices, 6))
+
+
+def test_extract_tiles_empty():
+    volume = make_volume()
+    assert extract_tiles(volume, np.empty((0, 3)), 6).shape == (0, 6, 6, 6, 2)
+
+
+def test_extract_tiles_imaris_volume(tmp_path):
+    volume = make_volume()
+    indices = make_indices(volume.shape)
+    with h5py.File(tmp_path / 'volume.h5', 'w') as fh:
+        # Datasets are stored in ZYX order.
+        datasets = [fh.create_dataset(f'c{c}', data=volume[..., c].T, chunks=(4, 8, 8),
+                                      compression='gzip')
+                    for c in range(volume.shape[-1])]
+        for max_workers in (1, 2):
+            lazy = ImarisVolume(datasets, volume.shape[:-1], max_workers)
+            tiles = extract_tiles(lazy, indices, 6, max_block_bytes=4096)
+            np.testing.assert_array_equal(tiles, extract_tiles_loop(volume, indices, 6))
+
+
+def make_nodes(seed=0):
+    # Spots for two markers with the nodes for each marker interleaved in the
+    # scene.
+    rng = np.random.default_rng(seed)
+    nodes = []
+    for i, (marker, n) in enumerate([('CtBP2', 30), ('GluR2', 12), ('CtBP2', 5)]):
+        points = rng.uniform(0, 5, size=(n, len(POINT_COLUMNS)))
+        points[:, :3] += LOWER
+        nodes.append((i + 1, marker, points))
+    return nodes
+
+
+def points_frame(nodes):
+    # DataFrame of the spots as built prior to `PointTable`.
+    frames = [pd.DataFrame(p, columns=POINT_COLUMNS) for _, _, p in nodes]
+    keys = [(i, m) for i, m, _ in nodes]
+    points = pd.concat(frames, keys=keys, names=['node_index', 'marker', 'i'])
+    for d, dim in enumerate('xyz'):
+        i = (points[dim] - LOWER[d]) / VOXEL_SIZE[d]
+        points[f'{dim}i'] = i.round().astype('i')
+    return points
+
+
+def test_point_table_to_frame():
+    nodes = make_nodes()
+    table = PointTable.from_nodes(nodes, LOWER, VOXEL_SIZE)
+    expected = points_frame(nodes)
+    assert table.markers == ['CtBP2', 'GluR2']
+    assert len(table) == len(expected)
+    for marker in table.markers:
+        pd.testing.assert_frame_equal(table.to_frame(marker),
+                                      expected.xs(marker, level='marker'))
+        np.testing.assert_array_equal(table.get_marker(marker).voxels,
+                                      expected.xs(marker, level='marker')[['xi', 'yi', 'zi']])
+    actual = table.to_frame()
+    actual.index = actual.index.set_levels(actual.index.levels[1].astype(object), level=1)
+    pd.testing.assert_frame_equal(actual.sort_index(), expected.sort_index(),
+                                  check_index_type=False)
+
+
+def test_point_table_missing_marker():
+    table = PointTable.from_nodes(make_nodes(), LOWER, VOXEL_SIZE)
+    with pytest.raises(KeyError):
+        table.get_marker('MyosinVIIa')
+
+
+@pytest.mark.parametrize('axis,z_slice', [('x', None), ('y', None), ('x', slice(3, 9)), ('y', 4)])
+def test_volume_side_projection(tmp_path, axis, z_slice):
+    volume = make_volume()
+    info = {'lower': LOWER, 'voxel_size': VOXEL_SIZE,
+            'channels': [{'name': 'GluR2'}, {'name': 'CtBP2'}]}
+    with h5py.File(tmp_path / 'volume.h5', 'w') as fh:
+        datasets = [fh.create_dataset(f'c{c}', data=volume[..., c].T, chunks=(4, 8, 8))
+                    for c in range(volume.shape[-1])]
+        lazy = ImarisVolume(datasets, volume.shape[:-1], 1)
+        lazy = VolumeNDImage(info, lazy, channel_defaults=CHANNEL_CONFIG, block_size=5)
+        actual = lazy.get_image(z_slice=z_slice, axis=axis)
+    channel_config = lazy.get_channel_config(None)
+    if isinstance(z_slice, int):
+        z_slice = slice(z_slice, z_slice + 1)
+    expected = get_image(volume, channel_config, z_slice=z_slice, axis=axis)
+    np.testing.assert_allclose(actual, expected, atol=1e-6)
+
+
+def test_point_table_rename_merges_markers():
+    nodes = make_nodes()
+    table = PointTable.from_nodes(nodes, LOWER, VOXEL_SIZE)
+    renamed = table.rename_markers({'GluR2': 'CtBP2'})
+    assert renamed.markers == ['CtBP2']
+    assert len(renamed.get_marker('CtBP2')) == len(table)
+    expected = points_frame([(i, 'CtBP2', p) for i, _, p in nodes])
+    pd.testing.assert_frame_equal(renamed.to_frame('CtBP2').sort_index(),
+                                  expected.xs('CtBP2', level='marker').sort_index())
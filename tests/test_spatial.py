@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from synaptogram.reader import PointTable
+from synaptogram.spatial import get_neighbor_info, SpatialIndex
+
+
+def brute_force(points, queries):
+    return np.linalg.norm(queries[:, np.newaxis] - points[np.newaxis], axis=-1)
+
+
+def make_points(n, seed):
+    # Points in the same clusters (including negative coordinates) so that
+    # some cells hold many points and others none.
+    centers = np.random.default_rng(0).uniform(-5, 5, size=(5, 3))
+    rng = np.random.default_rng(seed)
+    return centers[rng.integers(0, 5, size=n)] + rng.normal(scale=0.8, size=(n, 3))
+
+
+@pytest.mark.parametrize('radius,cell_size', [(1.0, 1.0), (0.5, 1.0), (1.5, 0.5)])
+def test_query_radius(radius, cell_size):
+    points, queries = make_points(300, 0), make_points(100, 1)
+    index = SpatialIndex(points, cell_size)
+    qi, pi, d = index.query_radius(queries, radius)
+    distance = brute_force(points, queries)
+    expected = set(zip(*np.nonzero(distance <= radius)))
+    assert set(zip(qi, pi)) == expected
+    np.testing.assert_allclose(d, distance[qi, pi])
+    np.testing.assert_array_equal(index.count_neighbors(queries, radius),
+                                  (distance <= radius).sum(axis=1))
+
+
+def test_query_nearest():
+    points, queries = make_points(300, 0), make_points(100, 1)
+    distance, index = SpatialIndex(points).query_nearest(queries, 0.5)
+    d = brute_force(points, queries)
+    found = d.min(axis=1) <= 0.5
+    np.testing.assert_allclose(distance[found], d.min(axis=1)[found])
+    np.testing.assert_array_equal(index[found], d.argmin(axis=1)[found])
+    assert np.isnan(distance[~found]).all()
+    assert (index[~found] == -1).all()
+
+
+def test_empty_index():
+    index = SpatialIndex(np.empty((0, 3)))
+    qi, pi, d = index.query_radius(make_points(10, 1), 1)
+    assert len(qi) == len(pi) == len(d) == 0
+    distance, nearest = index.query_nearest(make_points(10, 1), 1)
+    assert np.isnan(distance).all() and (nearest == -1).all()
+
+
+def test_neighbor_info():
+    ribbons, receptors = make_points(200, 0), make_points(150, 2)
+    values = np.zeros((350, 6))
+    values[:200, :3], values[200:, :3] = ribbons, receptors
+    nodes = [(1, 'CtBP2', values[:200]), (2, 'GluR2', values[200:])]
+    points = PointTable.from_nodes(nodes, np.zeros(3), np.ones(3))
+
+    info = get_neighbor_info(points, 'CtBP2', radius=0.75)
+    d = brute_force(receptors, ribbons)
+    within = d <= 0.75
+    np.testing.assert_array_equal(info['GluR2_count'], within.sum(axis=1))
+    expected = np.where(within.any(axis=1), d.min(axis=1), np.nan)
+    np.testing.assert_allclose(info['GluR2_distance'], expected)
+    np.testing.assert_array_equal(info['orphan_candidate'], ~within.any(axis=1))
@@ -0,0 +1,77 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from synaptogram.model import TiledNDImage
+from synaptogram.state import (
+    append_journal, journal_path, merge_journal, read_state, write_state
+)
+
+
+def make_state(labels):
+    return {
+        'data': {'points': {'labels': labels}, 'overview': {}},
+        'meta': {'history': []},
+    }
+
+
+def load_labels(path):
+    return merge_journal(read_state(path))['data']['points']['labels']
+
+
+def test_journal_replay(tmp_path):
+    path = tmp_path / 'analysis.json'
+    snapshot = make_state({'artifact': [1]})
+    write_state(path, snapshot)
+    generation = snapshot['meta']['generation']
+    append_journal(path, {'generation': generation, 'edits': [('add', 'orphan', 3)]})
+    append_journal(path, {'generation': generation, 'edits': [('remove', 'artifact', 1)]})
+    assert load_labels(path) == {'artifact': [], 'orphan': [3]}
+
+
+def test_crash_before_journal_removed(tmp_path, monkeypatch):
+    path = tmp_path / 'analysis.json'
+    snapshot = make_state({'artifact': [1]})
+    write_state(path, snapshot)
+    generation = snapshot['meta']['generation']
+    append_journal(path, {'generation': generation, 'edits': [('add', 'artifact', 2)]})
+    append_journal(path, {'generation': generation, 'edits': [('remove', 'artifact', 2)]})
+
+    # Compact after the user labels tile 2 again, but crash after the new
+    # snapshot replaces the old one and before the journal is removed.
+    def crash(self, missing_ok=False):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(Path, 'unlink', crash)
+    with pytest.raises(KeyboardInterrupt):
+        write_state(path, make_state({'artifact': [1, 2]}))
+    monkeypatch.undo()
+
+    assert journal_path(path).exists()
+    # Replaying the old journal would remove tile 2.
+    assert load_labels(path) == {'artifact': [1, 2]}
+
+
+def test_legacy_journal(tmp_path):
+    # Snapshots and journal entries written before generations were added
+    # have no generation. The entries are replayed since they match the
+    # (missing) generation of the snapshot.
+    path = tmp_path / 'analysis.json'
+    path.write_text(json.dumps(make_state({'artifact': [1]})))
+    append_journal(path, {'edits': [('add', 'orphan', 3)]})
+    assert load_labels(path) == {'artifact': [1], 'orphan': [3]}
+
+
+def test_repeated_label_not_journaled():
+    info = {'lower': [0, 0, 0], 'voxel_size': [0.1] * 3, 'channels': [{'name': 'CtBP2'}]}
+    tiles = np.zeros((3, 4, 4, 4, 1), dtype='uint8')
+    image = TiledNDImage(info, pd.DataFrame({'i': range(3)}), tiles)
+    updates = []
+    image.observe('labels_updated', updates.append)
+    image.label_tile(1, 'artifact')
+    image.label_tile(1, 'artifact')
+    image.unlabel_tile(2)
+    assert image.pending_edits == [('add', 'artifact', 1)]
+    assert len(updates) == 1
@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ndimage_enaml.sphere import sphere
+
+from synaptogram.model import masked_statistic, TiledNDImage
+from synaptogram.tilestore import TileCodec, TileStore
+
+
+INFO = {
+    'lower': [0, 0, 0],
+    'voxel_size': [0.1, 0.1, 0.1],
+    'channels': [{'name': 'GluR2'}, {'name': 'CtBP2'}],
+}
+
+
+def make_tiles(n=50, size=6, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 4000, size=(n, size, size, size, 2), dtype='uint16')
+
+
+def test_store_attach(tmp_path):
+    tiles = make_tiles()
+    store = TileStore.from_array(tiles, ['GluR2', 'CtBP2'], directory=tmp_path)
+    np.testing.assert_array_equal(TileStore.attach(store.spec), tiles)
+    path = store.path
+    del store
+    assert not path.exists()
+
+
+def test_masked_statistic_store(tmp_path):
+    tiles = make_tiles()
+    mask = sphere(tiles.shape[1], 2)
+    store = TileStore.from_array(tiles, directory=tmp_path)
+    for statistic in ('max', 'mean', 'median'):
+        expected = masked_statistic(tiles, mask, statistic)
+        actual = masked_statistic(store, mask, statistic, batch_size=16)
+        np.testing.assert_allclose(actual, expected)
+
+
+def test_tiled_image_uses_store():
+    tiles = make_tiles()
+    tile_info = pd.DataFrame({'i': np.arange(len(tiles))})
+    expected = TiledNDImage(INFO, tile_info, tiles)
+    actual = TiledNDImage(INFO, tile_info, tiles, tile_workers=2, min_mapped_tiles=0)
+    assert actual.tile_store is not None
+    np.testing.assert_array_equal(actual.ordering, expected.ordering)
+    np.testing.assert_allclose(actual.get_sort_statistics('mean', 0.3),
+                               expected.get_sort_statistics('mean', 0.3))
+
+
+def test_codec_lossless():
+    # The range of each channel fits in uint8, so no precision is lost.
+    rng = np.random.default_rng(0)
+    tiles = (rng.integers(0, 200, size=(20, 4, 4, 4, 2)) + [1000, 30000]).astype('uint16')
+    codec = TileCodec.fit(tiles, 'uint8')
+    encoded = codec.encode(tiles, 'uint8')
+    assert encoded.dtype == np.uint8
+    np.testing.assert_array_equal(codec.decode(encoded), tiles)
+    np.testing.assert_allclose(codec.decode(encoded, normalize=True), tiles / 65535, rtol=1e-6)
+
+
+def test_codec_lossy():
+    tiles = make_tiles()
+    codec = TileCodec.fit(tiles, 'uint8')
+    decoded = codec.decode(codec.encode(tiles, 'uint8'))
+    # Values are rounded to the nearest step.
+    assert np.abs(decoded - tiles).max() <= codec.scale.max() / 2 + 1e-3
+    restored = TileCodec.from_dict(codec.to_dict())
+    np.testing.assert_array_equal(restored.decode(codec.encode(tiles, 'uint8')), decoded)
+
+
+def test_codec_identity():
+    tiles = make_tiles()
+    codec = TileCodec.identity(tiles.dtype, 2)
+    assert codec.is_identity
+    assert codec.encode(tiles, tiles.dtype) is tiles
+    np.testing.assert_allclose(codec.decode(tiles, normalize=True), tiles / 65535, rtol=1e-6)
+    # Floating point tiles are already normalized.
+    tiles = tiles.astype('float32') / 65535
+    assert TileCodec.fit(tiles, 'float32').is_identity
+    codec = TileCodec.fit(tiles, 'uint8')
+    assert codec.source_max == 1
+    decoded = codec.decode(codec.encode(tiles, 'uint8'), normalize=True)
+    assert np.abs(decoded - tiles).max() <= codec.scale.max() / 2 + 1e-6
+
+
+@pytest.mark.parametrize('statistic', ['max', 'mean', 'median'])
+def test_masked_statistic_codec(statistic):
+    tiles = make_tiles()
+    codec = TileCodec.fit(tiles, 'uint8')
+    encoded = codec.encode(tiles, 'uint8')
+    mask = sphere(tiles.shape[1], 2)
+    expected = masked_statistic(codec.decode(encoded), mask, statistic)
+    actual = masked_statistic(encoded, mask, statistic, codec=codec)
+    np.testing.assert_allclose(actual, expected, rtol=1e-5)